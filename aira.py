@@ -1,12 +1,23 @@
+import asyncio
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 import os
 from dotenv import load_dotenv
 from database import Database
-from anilist_api import AniListAPI
-from typing import Dict
+from anilist_api import AniListAPI, BATCH_SIZE, PRIORITY_INTERACTIVE
+from scheduler import AiringSchedule
+from donator_index import DonatorIndex
+from title_index import TitleIndex
+from metrics import registry, start_server, timed, watch_event_loop_lag
+from diagnostics import Diagnostics
+from delivery import DeliveryPipeline, Digest, Notification, PRIORITY_DONATOR, PRIORITY_FREE
+from typing import Dict, Iterable, List, Optional, Set
 import time
+import zlib
+import logging
+import signal
+from datetime import datetime, timezone
 
 load_dotenv()
 TOKEN = os.getenv('DISCORD_TOKEN')
@@ -22,56 +33,169 @@ bot = commands.Bot(
     intents=intents
 )
 db = Database()
-anilist = AniListAPI()
+SCHEDULE_REFRESH_INTERVAL = int(os.getenv('SCHEDULE_REFRESH_INTERVAL', 3600))
+anilist = AniListAPI(
+    timeout=float(os.getenv('ANILIST_TIMEOUT', 10)),
+    max_concurrency=int(os.getenv('ANILIST_MAX_CONCURRENCY', 5)),
+    requests_per_minute=int(os.getenv('ANILIST_RATE_LIMIT', 90)),
+    cache_size=int(os.getenv('ANILIST_CACHE_SIZE', 5000)),
+    # Airing shows must not be served from cache for longer than the schedule refresh that rechecks them
+    cache_max_ttl=SCHEDULE_REFRESH_INTERVAL
+)
+PERSIST_ANIME_CACHE = os.getenv('PERSIST_ANIME_CACHE', 'true').lower() == 'true'
+CACHE_PERSIST_EVERY = 10  # ticks
 
-donator_cache: Dict[int, tuple[bool, float]] = {}
-CACHE_DURATION = 300
+donator_index = DonatorIndex()
+DONATOR_SYNC_KEY = 'donators_synced_at'
+DONATOR_RESYNC_INTERVAL = 86400
+DONATOR_FOOTER = "✨ Donator Server"
+
+delivery = DeliveryPipeline(
+    workers=int(os.getenv('DELIVERY_WORKERS', 8)),
+    sends_per_second=int(os.getenv('DELIVERY_SENDS_PER_SECOND', 40))
+)
+outbox_ready = asyncio.Event()
+OUTBOX_BATCH_SIZE = 500
+OUTBOX_RETENTION = 86400
+OUTBOX_SETTLE_INTERVAL = 0.5  # seconds between persisting finished sends while deliveries are in flight
+outbox_stats = {'sent': 0, 'failed': 0, 'deferred': 0}
+DIGEST_MAX_EMBEDS = 10  # Discord's per-message limit, larger digests become one summary embed
+DIGEST_MAX_CHARACTERS = 6000  # Discord's per-message embed text limit, longer digests are summarized too
+
+airing_schedule = AiringSchedule(refresh_interval=SCHEDULE_REFRESH_INTERVAL)
+anime_cache: Dict[int, Dict] = {}
+embed_cache: Dict[int, Dict[tuple, discord.Embed]] = {}
+MAX_SCHEDULE_SLEEP = 300
+
+# 'schedule' wakes up on each show's airingAt, 'window' asks AniList what aired since the last checkpoint
+DETECTION_MODE = os.getenv('DETECTION_MODE', 'schedule')
+AIRING_CHECKPOINT_KEY = 'airing_checkpoint'
+MAX_CATCH_UP = 7 * 86400
+aired_episodes: Dict[int, int] = {}  # anime_id -> latest episode seen in an airing window
+FREE_TIER_SLOTS = 10  # minutes between checks for free servers
+TICK_TIME_BUDGET = float(os.getenv('TICK_TIME_BUDGET', 45))  # seconds
+TICK_REQUEST_BUDGET = int(os.getenv('TICK_REQUEST_BUDGET', 20))  # AniList pages of stale shows per tick
+CHANNEL_GC_GRACE = int(os.getenv('CHANNEL_GC_GRACE', 86400))  # seconds a channel may stay unreachable
+missing_channels: Dict[str, float] = {}  # channel_id -> when it was first found unreachable
+free_slot_minute = None  # last wall-clock minute whose free slot was processed
+tick_stats = {'duration': 0.0, 'overruns': 0, 'carried_shows': 0, 'carried_slots': 0}
+
+# Prometheus metrics, served on localhost when METRICS_PORT is set
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+TICK_SECONDS = registry.histogram('aira_tick_seconds', 'check_new_episodes tick duration',
+                                  buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0, 90.0, 120.0))
+TICK_OVERRUNS = registry.counter('aira_tick_overruns_total', 'Ticks that went over budget or carried work over')
+OPERATION_SECONDS = registry.histogram('aira_operation_seconds', 'Duration of instrumented hot paths')
+DONATOR_LOOKUPS = registry.counter('aira_donator_lookups_total', 'Donator status lookups by result')
+EMBED_CACHE = registry.counter('aira_embed_cache_total', 'Episode embed cache lookups by result')
+DISCORD_RATE_LIMITS = registry.counter('aira_discord_rate_limits_total', '429 responses discord.py waited out')
+EVENT_LOOP_LAG = registry.histogram('aira_event_loop_lag_seconds', 'How late the event loop woke a 1s sleep',
+                                    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+registry.gauge('aira_subscriptions', 'Channel subscriptions', lambda: len(db.subscriptions))
+registry.gauge('aira_subscribed_channels', 'Channels with at least one subscription', lambda: len(db.subscriptions.channels))
+registry.gauge('aira_subscribed_shows', 'Shows with at least one subscriber', lambda: len(db.subscriptions.by_anime))
+registry.gauge('aira_donator_guilds', 'Guilds with a donator entitlement', lambda: len(donator_index))
+registry.gauge('aira_anime_cache_hit_ratio', 'AniList metadata cache hit ratio', lambda: anilist.cache.hit_ratio())
+registry.gauge('aira_anime_cache_entries', 'AniList metadata cache entries', lambda: len(anilist.cache))
+registry.gauge('aira_delivery_queue_depth', 'Notifications waiting for a delivery worker', lambda: delivery.queue.qsize())
+registry.gauge('aira_delivery_lag_p99_seconds', 'p99 time from detection to send', lambda: delivery.lag_percentile(99) or 0.0)
+
+class _RateLimitCounter(logging.Handler):
+    def emit(self, record: logging.LogRecord):
+        # Matches per-route "We are being rate limited" and "Global rate limit has been hit"
+        if record.levelno >= logging.WARNING and 'rate limit' in record.getMessage().lower():
+            DISCORD_RATE_LIMITS.inc()
+
+logging.getLogger('discord.http').addHandler(_RateLimitCounter())
+
+# Opt-in JSON-lines diagnostics: loop stalls with stack samples, command spans and on-demand profiles
+diagnostics = Diagnostics(
+    enabled=os.getenv('DIAGNOSTICS', 'false').lower() == 'true',
+    path=os.getenv('DIAGNOSTICS_LOG'),
+    block_ms=float(os.getenv('DIAGNOSTICS_BLOCK_MS', 100)),
+    profile_dir=os.getenv('DIAGNOSTICS_PROFILE_DIR', '.')
+)
+phase = diagnostics.phase
+
+title_index = TitleIndex()
+TITLE_SEASON_KEY = 'titles_season'
+TITLE_REFRESH_PAGES = int(os.getenv('TITLE_REFRESH_PAGES', 20))
+
+def is_donator_guild(guild_id: int) -> bool:
+    if not DONATOR_SKU_ID or guild_id is None:
+        return False
+    is_donator = donator_index.is_donator(guild_id)
+    DONATOR_LOOKUPS.inc(result='donator' if is_donator else 'free')
+    return is_donator
+
+def set_donator_footer(embed: discord.Embed, guild_id: int):
+    if is_donator_guild(guild_id):
+        embed.set_footer(text=DONATOR_FOOTER)
+
+def _is_donator_entitlement(entitlement: discord.Entitlement) -> bool:
+    return (
+        DONATOR_SKU_ID is not None and
+        str(entitlement.sku_id) == str(DONATOR_SKU_ID) and
+        entitlement.guild_id is not None
+    )
+
+async def track_entitlement(entitlement: discord.Entitlement):
+    if not _is_donator_entitlement(entitlement):
+        return
+
+    if entitlement.deleted or entitlement.is_expired():
+        donator_index.remove(entitlement.id)
+        await db.remove_donator_entitlement(entitlement.id)
+        return
+
+    ends_at = int(entitlement.ends_at.timestamp()) if entitlement.ends_at else None
+    donator_index.add(entitlement.id, entitlement.guild_id, ends_at)
+    await db.save_donator_entitlement(entitlement.id, entitlement.guild_id, ends_at)
+
+@tasks.loop(hours=1)
+async def sync_donators():
+    if not DONATOR_SKU_ID:
+        return
 
-async def is_donator_guild(guild_id: int) -> bool:
-    current_time = time.time()
-    
-    if guild_id in donator_cache:
-        status, timestamp = donator_cache[guild_id]
-        if current_time - timestamp < CACHE_DURATION:
-            return status
-    
     try:
-        if not DONATOR_SKU_ID:
-            return False
+        synced_at = await db.get_state(DONATOR_SYNC_KEY)
+        if synced_at and time.time() - float(synced_at) < DONATOR_RESYNC_INTERVAL:
+            return
+
+        entitlements = []
+        async for entitlement in bot.entitlements(limit=None, skus=[discord.Object(id=int(DONATOR_SKU_ID))], exclude_ended=True):
+            if _is_donator_entitlement(entitlement) and not entitlement.deleted:
+                ends_at = int(entitlement.ends_at.timestamp()) if entitlement.ends_at else None
+                entitlements.append((entitlement.id, entitlement.guild_id, ends_at))
+
+        await db.replace_donator_entitlements(entitlements)
+        donator_index.load(await db.get_donator_entitlements())
+        await db.set_state(DONATOR_SYNC_KEY, str(time.time()))
+        print(f"Synced {len(entitlements)} donator entitlements across {len(donator_index)} guilds")
 
-        route = discord.http.Route('GET', f'/applications/{bot.application_id}/entitlements')
-        try:
-            all_entitlements = await bot.http.request(route)
-            
-            guild_entitlements = [
-                e for e in all_entitlements 
-                if str(e.get('guild_id')) == str(guild_id) and 
-                str(e.get('sku_id')) == str(DONATOR_SKU_ID) and 
-                not e.get('deleted', False)
-            ]
-            
-            is_donator = len(guild_entitlements) > 0
-            donator_cache[guild_id] = (is_donator, current_time)
-            return is_donator
-            
-        except discord.NotFound:
-            donator_cache[guild_id] = (False, current_time)
-            return False
-            
     except Exception as e:
-        print(f"Error checking donator status: {str(e)}")
-        return False
+        print(f"Error syncing donator entitlements: {str(e)}")
 
-async def set_donator_footer(embed: discord.Embed, guild_id: int):
-    is_donator = await is_donator_guild(guild_id)
-    if is_donator:
-        embed.set_footer(text="✨ Donator Server")
+@bot.event
+async def on_entitlement_create(entitlement: discord.Entitlement):
+    await track_entitlement(entitlement)
+
+@bot.event
+async def on_entitlement_update(entitlement: discord.Entitlement):
+    await track_entitlement(entitlement)
+
+@bot.event
+async def on_entitlement_delete(entitlement: discord.Entitlement):
+    if _is_donator_entitlement(entitlement):
+        donator_index.remove(entitlement.id)
+        await db.remove_donator_entitlement(entitlement.id)
 
 class AnimeListPaginator(discord.ui.View):
-    def __init__(self, subscriptions: list, anime_data_list: list, per_page: int = 5):
+    def __init__(self, subscriptions: list, per_page: int = 5):
         super().__init__(timeout=30)
         self.subscriptions = subscriptions
-        self.anime_data_list = anime_data_list
+        self.anime_data: Dict[int, Dict] = {}
         self.per_page = per_page
         self.current_page = 0
         self.total_pages = max(1, (len(subscriptions) + per_page - 1) // per_page)
@@ -84,6 +208,35 @@ class AnimeListPaginator(discord.ui.View):
         self.next_button.disabled = self.current_page >= self.total_pages - 1
         self.last_page_button.disabled = self.current_page >= self.total_pages - 1
 
+    def _missing_page_ids(self) -> list:
+        start_idx = self.current_page * self.per_page
+        page = self.subscriptions[start_idx:start_idx + self.per_page]
+        return [sub['id'] for sub in page if self._get_anime_data(sub['id']) is None]
+
+    def _get_anime_data(self, anime_id: int):
+        return anime_cache.get(anime_id) or self.anime_data.get(anime_id)
+
+    async def load_current_page(self):
+        # Only the visible page is fetched, in one batched query that also fills AniListAPI's shared cache
+        missing_ids = self._missing_page_ids()
+        if missing_ids:
+            self.anime_data.update(await anilist.get_many_anime(missing_ids, PRIORITY_INTERACTIVE, profile='list'))
+
+    async def show_page(self, interaction: discord.Interaction, page: int):
+        self.current_page = page
+        self.update_buttons()
+
+        if self._missing_page_ids():
+            await interaction.response.defer()
+            await self.load_current_page()
+            embed = self.get_current_page_embed(interaction.guild_id)
+            set_donator_footer(embed, interaction.guild_id)
+            await interaction.edit_original_response(embed=embed, view=self)
+        else:
+            embed = self.get_current_page_embed(interaction.guild_id)
+            set_donator_footer(embed, interaction.guild_id)
+            await interaction.response.edit_message(embed=embed, view=self)
+
     def get_current_page_embed(self, guild_id: int) -> discord.Embed:
         embed = discord.Embed(
             title="📺 Channel Subscriptions",
@@ -96,7 +249,7 @@ class AnimeListPaginator(discord.ui.View):
 
         for i in range(start_idx, end_idx):
             sub = self.subscriptions[i]
-            anime_data = self.anime_data_list[i]
+            anime_data = self._get_anime_data(sub['id'])
             
             if anime_data:
                 english_title = anime_data['title'].get('english')
@@ -138,35 +291,19 @@ class AnimeListPaginator(discord.ui.View):
 
     @discord.ui.button(label="≪", style=discord.ButtonStyle.grey)
     async def first_page_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = 0
-        self.update_buttons()
-        embed = self.get_current_page_embed(interaction.guild_id)
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.response.edit_message(embed=embed, view=self)
+        await self.show_page(interaction, 0)
 
     @discord.ui.button(label="<", style=discord.ButtonStyle.blurple)
     async def prev_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = max(0, self.current_page - 1)
-        self.update_buttons()
-        embed = self.get_current_page_embed(interaction.guild_id)
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.response.edit_message(embed=embed, view=self)
+        await self.show_page(interaction, max(0, self.current_page - 1))
 
     @discord.ui.button(label=">", style=discord.ButtonStyle.blurple)
     async def next_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = min(self.total_pages - 1, self.current_page + 1)
-        self.update_buttons()
-        embed = self.get_current_page_embed(interaction.guild_id)
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.response.edit_message(embed=embed, view=self)
+        await self.show_page(interaction, min(self.total_pages - 1, self.current_page + 1))
 
     @discord.ui.button(label="≫", style=discord.ButtonStyle.grey)
     async def last_page_button(self, interaction: discord.Interaction, button: discord.ui.Button):
-        self.current_page = self.total_pages - 1
-        self.update_buttons()
-        embed = self.get_current_page_embed(interaction.guild_id)
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.response.edit_message(embed=embed, view=self)
+        await self.show_page(interaction, self.total_pages - 1)
 
 def _format_select_label(anime: dict) -> str:
     english_title = anime['title'].get('english')
@@ -191,35 +328,58 @@ async def on_ready():
     print(f'{bot.user} has connected to Discord!')
     print(f'Bot Application ID: {bot.application_id}')
     print(f'Invite URL: https://discord.com/api/oauth2/authorize?client_id={bot.application_id}&permissions=277025729600&scope=bot%20applications.commands%20applications.entitlements')
-    await db.init_db()
     await bot.tree.sync()
+    delivery.start()
+    if not drain_outbox.is_running():
+        drain_outbox.start()
+    if not sync_donators.is_running():
+        sync_donators.start()
     if not check_new_episodes.is_running():
         check_new_episodes.start()
+    if not refresh_title_index.is_running():
+        refresh_title_index.start()
+    if not sweep_dead_channels.is_running():
+        sweep_dead_channels.start()
+    if DETECTION_MODE == 'schedule' and not watch_airing.is_running():
+        watch_airing.start()
 
 @bot.tree.command(name='subscribe', description='Subscribe this channel to notifications for new episodes of an anime.')
+@diagnostics.traced('subscribe')
 async def subscribe(interaction: discord.Interaction, anime_name: str):
-    await interaction.response.defer()
-    anime_list = anilist.search_anime(anime_name)
+    with phase('defer'):
+        await interaction.response.defer()
+    with phase('api'):
+        # Autocomplete picks carry the anime ID, free text still goes through AniList search
+        anime = None
+        if anime_name.isdigit() and int(anime_name) in title_index.titles:
+            anime = await anilist.get_anime_details(int(anime_name), profile='search')
+        anime_list = [anime] if anime else await anilist.search_anime(anime_name)
     
     if not anime_list:
-        await interaction.followup.send('Could not find any anime with that name.')
+        with phase('send'):
+            await interaction.followup.send('Could not find any anime with that name.')
         return
 
     if len(anime_list) == 1:
         anime = anime_list[0]
         channel_id = str(interaction.channel.id)
         
-        subs = await db.get_channel_subscriptions(channel_id)
+        with phase('db'):
+            subs = await db.get_channel_subscriptions(channel_id)
         if any(sub['id'] == anime['id'] for sub in subs):
-            await interaction.followup.send(f"This channel is already subscribed to {anime['title']['romaji']}.")
+            with phase('send'):
+                await interaction.followup.send(f"This channel is already subscribed to {anime['title']['romaji']}.")
             return
 
-        await db.add_subscription(
-            channel_id=channel_id,
-            anime_id=anime['id'],
-            title=anime['title']['romaji'],
-            episodes=anime.get('nextAiringEpisode', {}).get('episode', 0) - 1 if anime.get('nextAiringEpisode') else anime.get('episodes', 0)
-        )
+        track_anime(anime)
+        with phase('db'):
+            await db.add_subscription(
+                channel_id=channel_id,
+                anime_id=anime['id'],
+                title=anime['title']['romaji'],
+                episodes=anime.get('nextAiringEpisode', {}).get('episode', 0) - 1 if anime.get('nextAiringEpisode') else anime.get('episodes', 0),
+                guild_id=interaction.guild_id
+            )
 
         embed = discord.Embed(
             title="✅ Channel Subscription Added!",
@@ -246,8 +406,9 @@ async def subscribe(interaction: discord.Interaction, anime_name: str):
         if anime.get('genres'):
             embed.add_field(name="Genres", value=", ".join(anime['genres'][:3]), inline=True)
 
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.followup.send(embed=embed)
+        set_donator_footer(embed, interaction.guild_id)
+        with phase('send'):
+            await interaction.followup.send(embed=embed)
     else:
         select = discord.ui.Select(
             placeholder="Select an anime",
@@ -278,11 +439,13 @@ async def subscribe(interaction: discord.Interaction, anime_name: str):
                     )
                     return
 
+                track_anime(selected_anime)
                 await db.add_subscription(
                     channel_id=channel_id,
                     anime_id=selected_anime['id'],
                     title=selected_anime['title']['romaji'],
-                    episodes=selected_anime.get('nextAiringEpisode', {}).get('episode', 0) - 1 if selected_anime.get('nextAiringEpisode') else selected_anime.get('episodes', 0)
+                    episodes=selected_anime.get('nextAiringEpisode', {}).get('episode', 0) - 1 if selected_anime.get('nextAiringEpisode') else selected_anime.get('episodes', 0),
+                    guild_id=interaction.guild_id
                 )
 
                 embed = discord.Embed(
@@ -322,46 +485,97 @@ async def subscribe(interaction: discord.Interaction, anime_name: str):
                         inline=True
                     )
 
-                await set_donator_footer(embed, interaction.guild_id)
+                set_donator_footer(embed, interaction.guild_id)
                 await select_interaction.response.edit_message(embed=embed, view=None)
 
         select.callback = select_callback
         view = discord.ui.View()
         view.add_item(select)
-        await interaction.followup.send("Multiple anime found. Please select one:", view=view)
+        with phase('send'):
+            await interaction.followup.send("Multiple anime found. Please select one:", view=view)
+
+@subscribe.autocomplete('anime_name')
+async def subscribe_autocomplete(interaction: discord.Interaction, current: str):
+    choices = []
+    for anime_id in title_index.search(current):
+        titles = title_index.titles[anime_id]
+        label = _format_select_label({'title': titles})
+        choices.append(app_commands.Choice(name=label, value=str(anime_id)))
+    return choices
 
 @bot.tree.command(name='list', description='Lists all anime subscriptions in this channel.')
+@diagnostics.traced('list')
 async def list_anime(interaction: discord.Interaction):
     channel_id = str(interaction.channel.id)
-    subscriptions = await db.get_channel_subscriptions(channel_id)
+    with phase('db'):
+        subscriptions = await db.get_channel_subscriptions(channel_id)
     
     if subscriptions:
-        anime_data_list = [anilist.get_anime_details(sub['id']) for sub in subscriptions]
-        
-        paginator = AnimeListPaginator(subscriptions, anime_data_list)
+        with phase('defer'):
+            await interaction.response.defer()
+        paginator = AnimeListPaginator(subscriptions)
+        with phase('api'):
+            await paginator.load_current_page()
         
         embed = paginator.get_current_page_embed(interaction.guild_id)
-        await set_donator_footer(embed, interaction.guild_id)
-        await interaction.response.send_message(embed=embed, view=paginator)
+        set_donator_footer(embed, interaction.guild_id)
+        with phase('send'):
+            await interaction.followup.send(embed=embed, view=paginator)
     else:
-        await interaction.response.send_message(
-            "This channel has no anime subscriptions.",
-            ephemeral=True
-        )
+        with phase('send'):
+            await interaction.response.send_message(
+                "This channel has no anime subscriptions.",
+                ephemeral=True
+            )
 
 @bot.tree.command(name='unsubscribe', description='Stop notifications for an anime in this channel.')
+@diagnostics.traced('unsubscribe')
 async def unsubscribe(interaction: discord.Interaction, anime_name: str):
     channel_id = str(interaction.channel.id)
-    if await db.remove_subscription_by_title(channel_id, anime_name):
-        await interaction.response.send_message(
-            f"Successfully unsubscribed this channel from {anime_name}.",
-            ephemeral=True
-        )
+    with phase('db'):
+        removed = False
+        if anime_name.isdigit():
+            # Autocomplete picks carry the anime ID, which stays exact when titles are truncated or shared
+            anime_id = int(anime_name)
+            for sub in await db.get_channel_subscriptions(channel_id):
+                if sub['id'] == anime_id:
+                    removed = await db.remove_subscription(channel_id, anime_id)
+                    anime_name = sub['title']
+                    break
+        if not removed:
+            # Typed names, including numeric titles, still match by title
+            removed = await db.remove_subscription_by_title(channel_id, anime_name)
+    with phase('send'):
+        if removed:
+            await interaction.response.send_message(
+                f"Successfully unsubscribed this channel from {anime_name}.",
+                ephemeral=True
+            )
+        else:
+            await interaction.response.send_message(
+                f"Could not find a subscription for {anime_name} in this channel.",
+                ephemeral=True
+            )
+
+@unsubscribe.autocomplete('anime_name')
+async def unsubscribe_autocomplete(interaction: discord.Interaction, current: str):
+    subscriptions = await db.get_channel_subscriptions(str(interaction.channel_id))
+    ids_by_title: Dict[str, List[int]] = {}
+    for sub in subscriptions:
+        ids_by_title.setdefault(sub['title'], []).append(sub['id'])
+    titles = TitleIndex.filter_titles(current, (sub['title'] for sub in subscriptions))
+    return [app_commands.Choice(name=title[:100], value=str(ids_by_title[title].pop(0))) for title in titles]
+
+@bot.tree.command(name='digest', description='Bundle new-episode notifications in this channel into one message per window.')
+@app_commands.describe(minutes='How long to collect episodes before sending them together, 0 turns digests off')
+async def digest(interaction: discord.Interaction, minutes: app_commands.Range[int, 0, 1440]):
+    channel_id = str(interaction.channel.id)
+    await db.set_digest_window(channel_id, minutes * 60)
+    if minutes:
+        message = f"New episodes in this channel will now be sent together, collected over {minutes} minute{'s' if minutes != 1 else ''}."
     else:
-        await interaction.response.send_message(
-            f"Could not find a subscription for {anime_name} in this channel.",
-            ephemeral=True
-        )
+        message = "Digest mode is off, each new episode will be sent as soon as it airs."
+    await interaction.response.send_message(message, ephemeral=True)
 
 @bot.tree.command(name='unsubscribe_all', description='Stop all anime notifications in this channel.')
 async def unsubscribe_all(interaction: discord.Interaction):
@@ -394,6 +608,7 @@ async def about(interaction: discord.Interaction):
 • `/subscribe [anime_name]` - Subscribe this channel to notifications for an anime
 • `/unsubscribe [anime_name]` - Unsubscribe this channel from notifications for a specific anime
 • `/unsubscribe_all` - Remove all anime subscriptions from this channel
+• `/digest [minutes]` - Bundle new episodes into one message per window, 0 turns it off
 • `/list` - Show all anime subscriptions in this channel
 • `/donator_status` - Check this server's donator status
 • `/about` - Show this message
@@ -431,79 +646,391 @@ async def about(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
-@tasks.loop(minutes=1)
-async def check_new_episodes():
-    try:
-        all_subscriptions = await db.get_all_subscriptions()
-        
-        for channel_id, subscriptions in all_subscriptions.items():
+def track_anime(anime_data: Dict):
+    anime_cache[anime_data['id']] = anime_data
+    title = anime_data.get('title') or {}
+    if title.get('romaji'):
+        # poll and search payloads carry no native title, keep the one the index already has
+        known = title_index.titles.get(anime_data['id'], {})
+        titles = (
+            title['romaji'],
+            title['english'] if 'english' in title else known.get('english'),
+            title['native'] if 'native' in title else known.get('native'),
+        )
+        if titles != tuple(known.get(key) for key in ('romaji', 'english', 'native')):
+            title_index.add(anime_data['id'], *titles)
+    embed_cache.pop(anime_data['id'], None)
+    airing_schedule.update(anime_data['id'], anime_data)
+
+@timed(OPERATION_SECONDS, operation='refresh_anime')
+async def refresh_anime(anime_ids: Iterable[int]):
+    anime_ids = list(anime_ids)
+    not_found: Set[int] = set()
+    anime_data_by_id = await anilist.get_many_anime(anime_ids, profile='poll', not_found=not_found)
+    for anime_id in anime_ids:
+        anime_data = anime_data_by_id.get(anime_id) or anime_cache.get(anime_id)
+        if not anime_data:
+            if anime_id in not_found:
+                # Deleted or merged on AniList, wait a full refresh interval before asking again
+                airing_schedule.update(anime_id, {})
+            print(f"No anime data found for ID {anime_id}")
+            continue
+        track_anime(anime_data)
+
+@timed(OPERATION_SECONDS, operation='detect_aired_window')
+async def detect_aired_window(anime_ids: Iterable[int]):
+    now = int(time.time())
+    checkpoint = await db.get_state(AIRING_CHECKPOINT_KEY)
+    since = int(checkpoint) if checkpoint else 0
+    if not aired_episodes:
+        # Free-tier slots still waiting on episodes found before a restart would otherwise be skipped
+        since -= FREE_TIER_SLOTS * 60
+    since = max(since, now - MAX_CATCH_UP)
+
+    anime_ids = list(anime_ids)
+    if anime_ids:
+        schedules = await anilist.get_aired_episodes(anime_ids, since, now)
+        if schedules is None:
+            return
+        for schedule in schedules:
+            track_anime(schedule['media'])
+            # The schedule's own episode number, media has no nextAiringEpisode left after a finale
+            anime_id = schedule['media']['id']
+            aired_episodes[anime_id] = max(aired_episodes.get(anime_id, 0), schedule['episode'])
+
+    await db.set_state(AIRING_CHECKPOINT_KEY, str(now))
+
+def free_tier_slot(channel_id: str, guild_id: Optional[int]) -> int:
+    # crc32 rather than hash() so a server keeps its slot across restarts
+    return zlib.crc32(str(guild_id or channel_id).encode()) % FREE_TIER_SLOTS
+
+@timed(OPERATION_SECONDS, operation='notify_subscribers')
+async def notify_subscribers(anime_ids: Iterable[int], include_free: bool = True, free_slot: Optional[int] = None):
+    notifications = []
+
+    for anime_id in anime_ids:
+        anime_data = anime_cache.get(anime_id)
+        if not anime_data:
+            continue
+
+        current_episode = max(anilist.get_latest_episode(anime_data), aired_episodes.get(anime_id, 0))
+
+        for channel_id, episodes in list(db.subscriptions.subscribers(anime_id).items()):
             try:
+                if current_episode <= (episodes or 0):
+                    continue
+
                 channel = bot.get_channel(int(channel_id))
                 if not channel:
+                    missing_channels.setdefault(channel_id, time.time())
                     continue
 
-                is_donator = await is_donator_guild(channel.guild.id)
-                
-                if not is_donator and check_new_episodes.current_loop % 10 != 0:
+                state = db.subscriptions.channels[channel_id]
+                if state.guild_id is None:
+                    await db.set_channel_guild(channel_id, channel.guild.id)
+
+                is_donator = is_donator_guild(channel.guild.id)
+                if not is_donator and not include_free:
+                    continue
+                if not is_donator and free_slot is not None and free_tier_slot(channel_id, channel.guild.id) != free_slot:
                     continue
-                    
-                for sub in subscriptions:
-                    try:
-                        anime_data = anilist.get_anime_details(sub['id'])
-                        if not anime_data:
-                            print(f"No anime data found for ID {sub['id']}")
-                            continue
-
-                        next_episode = anime_data.get('nextAiringEpisode', {})
-                        if not next_episode:
-                            continue
-
-                        current_episode = next_episode.get('episode', 0)
-                        airing_at = next_episode.get('airingAt', 0)
-                        current_time = int(time.time())
-                        
-                        if current_episode and current_episode > sub['episodes'] and current_time > airing_at:
-                            embed = discord.Embed(
-                                title="🎬 New Episode Available!",
-                                description=f"Episode {current_episode} of {anime_data['title']['romaji']} is now available!",
-                                color=discord.Color.green()
-                            )
-
-                            if anime_data['title'].get('english'):
-                                embed.add_field(
-                                    name="English Title",
-                                    value=anime_data['title']['english'],
-                                    inline=True
-                                )
-
-                            if anime_data.get('nextAiringEpisode'):
-                                embed.add_field(
-                                    name="Next Episode",
-                                    value=anilist.format_airing_info(anime_data['nextAiringEpisode']),
-                                    inline=False
-                                )
-
-                            if anime_data.get('coverImage', {}).get('medium'):
-                                embed.set_thumbnail(url=anime_data['coverImage']['medium'])
-
-                            await set_donator_footer(embed, channel.guild.id)
-                            await channel.send(embed=embed)
-                            await db.update_episodes(sub['id'], current_episode)
-
-                    except Exception as e:
-                        print(f"Error processing anime {sub['id']}: {str(e)}")
-                        continue
+
+                notifications.append((channel_id, anime_id, current_episode, PRIORITY_DONATOR if is_donator else PRIORITY_FREE))
 
             except Exception as e:
-                print(f"Error processing channel {channel_id}: {str(e)}")
+                print(f"Error notifying channel {channel_id} about anime {anime_id}: {str(e)}")
                 continue
 
+    if notifications:
+        await db.enqueue_notifications(notifications)
+        outbox_ready.set()
+
+def get_episode_embed(anime_data: Dict, episode: int, is_donator: bool) -> discord.Embed:
+    # Rendered once per (anime, episode, tier) and shared by every channel that receives it
+    rendered = embed_cache.setdefault(anime_data['id'], {})
+    embed = rendered.get((episode, is_donator))
+    EMBED_CACHE.inc(result='miss' if embed is None else 'hit')
+    if embed is None:
+        embed = discord.Embed.from_dict(anilist.get_episode_update_embed(anime_data, episode))
+        if is_donator:
+            embed.set_footer(text=DONATOR_FOOTER)
+        rendered[(episode, is_donator)] = embed
+    return embed
+
+def build_digest(channel_id: str, entries: list) -> tuple:
+    """Turn one digest channel's (channel, anime_data, episode, priority, created_at) rows into a single send."""
+    channel = entries[0][0]
+    is_donator = is_donator_guild(channel.guild.id)
+    priority = min(entry[3] for entry in entries)
+    queued_at = min(entry[4] for entry in entries)
+    if len(entries) == 1:
+        _, anime_data, episode, _, _ = entries[0]
+        embed = get_episode_embed(anime_data, episode, is_donator)
+        return Notification(channel, channel_id, anime_data['id'], episode, embed, queued_at), priority
+
+    keys = [(channel_id, anime_data['id'], episode) for _, anime_data, episode, _, _ in entries]
+    embeds = []
+    if len(entries) <= DIGEST_MAX_EMBEDS:
+        embeds = [get_episode_embed(anime_data, episode, is_donator) for _, anime_data, episode, _, _ in entries]
+    if not embeds or sum(len(embed) for embed in embeds) > DIGEST_MAX_CHARACTERS:
+        embed = discord.Embed.from_dict(anilist.get_digest_embed([(anime_data, episode) for _, anime_data, episode, _, _ in entries]))
+        set_donator_footer(embed, channel.guild.id)
+        embeds = [embed]
+    return Digest(channel, channel_id, keys, embeds, queued_at), priority
+
+async def settle_deliveries() -> int:
+    """Persist the outcome of sends that finished since the last call and release their keys."""
+    sent, failed = delivery.take_results()
+    if not sent and not failed:
+        return 0
+    await db.complete_notifications(sent, failed)
+    delivery.release(sent + failed)
+
+    now = time.time()
+    gone = []
+    for channel_id, deleted in delivery.take_unreachable().items():
+        if deleted:
+            gone.append(channel_id)
+        else:
+            missing_channels.setdefault(channel_id, now)
+    await reclaim_channels(gone, 'channel not found')
+
+    outbox_stats['sent'] += len(sent)
+    outbox_stats['failed'] += len(failed)
+    if not delivery.in_flight:
+        print(f"Outbox drained: {outbox_stats['sent']} sent, {outbox_stats['failed']} failed, "
+              f"{outbox_stats['deferred']} deferred, {await db.get_outbox_depth()} pending, "
+              f"lag p50 {delivery.lag_percentile(50) or 0:.2f}s p99 {delivery.lag_percentile(99) or 0:.2f}s")
+        outbox_stats.update(sent=0, failed=0, deferred=0)
+    return len(sent) + len(failed)
+
+async def claim_pending() -> int:
+    """Hand due outbox rows that are not already being sent to the delivery workers."""
+    rows = await db.get_pending_notifications(OUTBOX_BATCH_SIZE + len(delivery.in_flight))
+    rows = [row for row in rows if row[:3] not in delivery.in_flight][:OUTBOX_BATCH_SIZE]
+    if not rows:
+        return 0
+
+    missing_ids = {row[1] for row in rows if row[1] not in anime_cache}
+    if missing_ids:
+        await refresh_anime(missing_ids)
+
+    unavailable = []
+    deferred = []
+    discarded = []
+    digests: Dict[str, list] = {}
+    claimed = 0
+    for channel_id, anime_id, episode, priority, created_at in rows:
+        if channel_id not in db.subscriptions.subscribers(anime_id):
+            # Unsubscribed while the row was waiting, e.g. during a digest window
+            discarded.append((channel_id, anime_id, episode))
+            continue
+        channel = bot.get_channel(int(channel_id))
+        anime_data = anime_cache.get(anime_id)
+        if not channel:
+            # Usually a guild outage or a cold cache, the dead channel sweep handles the rest
+            deferred.append((channel_id, anime_id, episode))
+            continue
+        if not anime_data:
+            unavailable.append((channel_id, anime_id, episode))
+            continue
+        if channel_id in db.digest_windows:
+            digests.setdefault(channel_id, []).append((channel, anime_data, episode, priority, created_at))
+            continue
+        embed = get_episode_embed(anime_data, episode, is_donator_guild(channel.guild.id))
+        delivery.put(Notification(channel, channel_id, anime_id, episode, embed, created_at), priority)
+        claimed += 1
+
+    for channel_id, entries in digests.items():
+        delivery.put(*build_digest(channel_id, entries))
+        claimed += 1
+
+    await db.complete_notifications([], unavailable, deferred, discarded)
+    outbox_stats['failed'] += len(unavailable)
+    outbox_stats['deferred'] += len(deferred)
+    return claimed
+
+@tasks.loop()
+async def drain_outbox():
+    # Rows are claimed as workers free up instead of batch by batch, so one slow send
+    # never holds back newer notifications
+    outbox_ready.clear()
+    try:
+        settled = await settle_deliveries()
+        if delivery.queue.qsize() < OUTBOX_BATCH_SIZE and await claim_pending():
+            return
+        if settled and not delivery.in_flight:
+            return  # freshly drained, check for due rows again before idling
+    except Exception as e:
+        print(f"Error in drain_outbox: {str(e)}")
+        await asyncio.sleep(5)
+        return
+
+    if delivery.in_flight:
+        timeout = OUTBOX_SETTLE_INTERVAL
+    else:
+        timeout = 60
+        next_due_at = await db.get_next_due_at()
+        if next_due_at:
+            timeout = min(timeout, max(1, next_due_at - time.time()))
+    try:
+        await asyncio.wait_for(outbox_ready.wait(), timeout=timeout)
+    except asyncio.TimeoutError:
+        if not delivery.in_flight:
+            await db.prune_outbox(int(time.time()) - OUTBOX_RETENTION)
+
+async def reclaim_channels(channel_ids: List[str], reason: str):
+    if not channel_ids:
+        return
+    removed, shows = await db.remove_channels(channel_ids)
+    for channel_id in channel_ids:
+        missing_channels.pop(channel_id, None)
+    if removed:
+        print(f"Reclaimed {removed} subscriptions from {len(channel_ids)} channels ({reason}), "
+              f"{shows} shows no longer polled")
+
+def _is_reachable(channel) -> bool:
+    if channel is None or getattr(channel, 'guild', None) is None:
+        return False  # DM channels have no guild, notifications only go to server channels
+    permissions = channel.permissions_for(channel.guild.me)
+    return permissions.send_messages and permissions.embed_links
+
+@tasks.loop(hours=1)
+async def sweep_dead_channels():
+    """Drop subscriptions of channels that stayed deleted or unwritable for the whole grace period."""
+    try:
+        now = time.time()
+        for channel_id, state in list(db.subscriptions.channels.items()):
+            guild = bot.get_guild(state.guild_id) if state.guild_id else None
+            if guild is not None and guild.unavailable:
+                continue  # Discord outage, not a dead channel
+            if _is_reachable(bot.get_channel(int(channel_id))):
+                missing_channels.pop(channel_id, None)
+            else:
+                missing_channels.setdefault(channel_id, now)
+
+        for channel_id in [channel_id for channel_id in missing_channels if channel_id not in db.subscriptions.channels]:
+            del missing_channels[channel_id]
+
+        expired = [channel_id for channel_id, since in missing_channels.items() if now - since >= CHANNEL_GC_GRACE]
+        await reclaim_channels(expired, 'unreachable past grace period')
+
+    except Exception as e:
+        print(f"Error sweeping dead channels: {str(e)}")
+
+@bot.event
+async def on_guild_channel_delete(channel: discord.abc.GuildChannel):
+    # Most deleted channels never had subscriptions, skip the database round trip for them
+    if str(channel.id) not in db.subscriptions.channels:
+        return
+    await reclaim_channels([str(channel.id)], 'channel deleted')
+
+@bot.event
+async def on_guild_remove(guild: discord.Guild):
+    channel_ids = db.subscriptions.guild_channels(guild.id)
+    if not channel_ids:
+        return
+    await reclaim_channels(channel_ids, 'removed from server')
+
+@tasks.loop(minutes=1)
+@timed(TICK_SECONDS)
+async def check_new_episodes():
+    global free_slot_minute
+    started = time.monotonic()
+    deadline = started + TICK_TIME_BUDGET
+    carried_shows = 0
+    try:
+        anime_ids = db.subscriptions.anime_ids()
+
+        for anime_id in set(anime_cache) - anime_ids:
+            del anime_cache[anime_id]
+            embed_cache.pop(anime_id, None)
+            aired_episodes.pop(anime_id, None)
+            airing_schedule.forget(anime_id)
+
+        if DETECTION_MODE == 'window':
+            await detect_aired_window(anime_ids)
+        else:
+            # Whatever does not fit in this tick's request budget stays stale and goes first next tick
+            budget = TICK_REQUEST_BUDGET * BATCH_SIZE
+            stale_ids = airing_schedule.stale(anime_ids)
+            if len(stale_ids) > budget:
+                carried_shows = len(stale_ids) - budget
+                stale_ids = airing_schedule.stale(stale_ids, limit=budget)
+            if stale_ids:
+                await refresh_anime(stale_ids)
+
+        # Free slots follow the wall clock, so a slow tick delays a slot instead of skipping it
+        minute = int(time.time() // 60)
+        if free_slot_minute is None:
+            free_slot_minute = minute - 1
+        # Ten or more minutes behind means every slot is due, one pass over each covers it
+        free_slot_minute = max(free_slot_minute, minute - FREE_TIER_SLOTS)
+        await notify_subscribers(anime_ids, include_free=False)
+        while free_slot_minute < minute and time.monotonic() < deadline:
+            free_slot_minute += 1
+            await notify_subscribers(anime_ids, free_slot=free_slot_minute % FREE_TIER_SLOTS)
+
+        if PERSIST_ANIME_CACHE and check_new_episodes.current_loop % CACHE_PERSIST_EVERY == 0:
+            await db.save_cached_anime(anilist.cache.dump())
+
     except Exception as e:
         print(f"Error in check_new_episodes: {str(e)}")
 
+    finally:
+        duration = time.monotonic() - started
+        carried_slots = int(time.time() // 60) - free_slot_minute if free_slot_minute is not None else 0
+        tick_stats['duration'] = duration
+        tick_stats['carried_shows'] = carried_shows
+        tick_stats['carried_slots'] = carried_slots
+        if duration > TICK_TIME_BUDGET or carried_shows or carried_slots > 1:
+            tick_stats['overruns'] += 1
+            TICK_OVERRUNS.inc()
+            print(f"check_new_episodes is falling behind: tick took {duration:.1f}s, "
+                  f"{carried_shows} stale shows and {carried_slots} free slots carried over")
+
+@tasks.loop()
+async def watch_airing():
+    airing_schedule.changed.clear()
+    next_airing_at = airing_schedule.next_airing_at()
+    delay = MAX_SCHEDULE_SLEEP if next_airing_at is None else next_airing_at - time.time()
+
+    if delay > 0:
+        try:
+            await asyncio.wait_for(airing_schedule.changed.wait(), timeout=min(delay, MAX_SCHEDULE_SLEEP))
+        except asyncio.TimeoutError:
+            pass
+        return
+
+    try:
+        due_ids = airing_schedule.pop_due()
+        await refresh_anime(due_ids)
+        await notify_subscribers(due_ids, include_free=False)
+
+    except Exception as e:
+        print(f"Error in watch_airing: {str(e)}")
+
+@app_commands.command(name='profile', description='Start or stop a cProfile capture of the bot (owner only).')
+async def profile(interaction: discord.Interaction):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot owner can use this command.", ephemeral=True)
+        return
+
+    if diagnostics.profiling:
+        path = diagnostics.stop_profile()
+        message = f"Profile saved to `{path}`, the slowest functions are in the diagnostics log."
+    else:
+        diagnostics.start_profile()
+        message = "Profiling started, run /profile again to stop and save it."
+    await interaction.response.send_message(message, ephemeral=True)
+
+# Only registered in diagnostics mode, SIGUSR1 toggles the same capture from a shell
+if diagnostics.enabled:
+    bot.tree.add_command(profile)
+
 @bot.tree.command(name='donator_status', description='Check the donator status of this server')
 async def donator_status(interaction: discord.Interaction):
-    is_donator = await is_donator_guild(interaction.guild_id)
+    is_donator = is_donator_guild(interaction.guild_id)
     
     embed = discord.Embed(
         title="Donator Status",
@@ -526,4 +1053,68 @@ async def donator_status(interaction: discord.Interaction):
     
     await interaction.response.send_message(embed=embed)
 
-bot.run(TOKEN) 
\ No newline at end of file
+def _current_season(now: datetime) -> str:
+    season = ('WINTER', 'SPRING', 'SUMMER', 'FALL')[(now.month - 1) // 3]
+    return f"{now.year}-{season}"
+
+@tasks.loop(hours=24)
+async def refresh_title_index():
+    """Bulk-load this season's airing and upcoming titles once per season."""
+    try:
+        season = _current_season(datetime.now(timezone.utc))
+        if await db.get_state(TITLE_SEASON_KEY) == season:
+            return
+
+        media = await anilist.get_current_titles(max_pages=TITLE_REFRESH_PAGES)
+        if not media:
+            return
+
+        rows = [
+            (anime['id'], anime['title']['romaji'], anime['title'].get('english'), anime['title'].get('native'))
+            for anime in media if anime['title'].get('romaji')
+        ]
+        await db.save_anime_titles(rows)
+        for row in rows:
+            title_index.add(*row)
+        await db.set_state(TITLE_SEASON_KEY, season)
+        print(f"Refreshed title index for {season}: {len(rows)} titles, {len(title_index)} indexed")
+
+    except Exception as e:
+        print(f"Error refreshing title index: {str(e)}")
+
+async def main():
+    await db.init_db()
+    for row in await db.get_anime_titles():
+        title_index.add(*row)
+    donator_index.load(await db.get_donator_entitlements())
+    if PERSIST_ANIME_CACHE:
+        anilist.cache.load(await db.get_cached_anime())
+    diagnostics.start()
+    if diagnostics.enabled and hasattr(signal, 'SIGUSR1'):
+        asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, diagnostics.toggle_profile)
+    metrics_runner = None
+    lag_watcher = None
+    if METRICS_PORT:
+        metrics_runner = await start_server(METRICS_HOST, int(METRICS_PORT))
+        lag_watcher = asyncio.create_task(watch_event_loop_lag(EVENT_LOOP_LAG))
+    async with bot:
+        try:
+            await bot.start(TOKEN)
+        finally:
+            if lag_watcher is not None:
+                lag_watcher.cancel()
+            if metrics_runner is not None:
+                await metrics_runner.cleanup()
+            drain_outbox.cancel()
+            refresh_title_index.cancel()
+            sweep_dead_channels.cancel()
+            await delivery.stop()
+            await db.complete_notifications(*delivery.take_results())
+            if PERSIST_ANIME_CACHE:
+                await db.save_cached_anime(anilist.cache.dump())
+            await anilist.close()
+            await db.close()
+            await diagnostics.stop()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,145 +1,559 @@
-import requests
-from typing import Dict, List, Optional, Any
-from datetime import datetime
+import asyncio
+import heapq
+import itertools
+import json
+import time
+import aiohttp
+from collections import OrderedDict
+from typing import Dict, List, Optional, Any, Set, Tuple
+from database import normalize_title
+from metrics import registry
 
 ANILIST_URL = 'https://graphql.anilist.co'
+BATCH_SIZE = 50  # AniList caps perPage at 50
+MAX_RETRIES = 3
+DEFAULT_RETRY_AFTER = 60
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+
+# Named Media field selections, each caller asks for the smallest one that covers what it reads
+QUERY_PROFILES = {
+    # Notification path: detection and the episode embed
+    'poll': '''
+        id
+        title {
+            romaji
+            english
+        }
+        coverImage {
+            medium
+        }
+        episodes
+        status
+        nextAiringEpisode {
+            episode
+            airingAt
+            timeUntilAiring
+        }
+    ''',
+    # /list pages
+    'list': '''
+        id
+        title {
+            romaji
+            english
+        }
+        episodes
+        status
+        nextAiringEpisode {
+            episode
+            airingAt
+            timeUntilAiring
+        }
+    ''',
+    # /subscribe search results and confirmation embed
+    'search': '''
+        id
+        title {
+            romaji
+            english
+        }
+        coverImage {
+            medium
+        }
+        episodes
+        status
+        genres
+        averageScore
+        nextAiringEpisode {
+            episode
+            airingAt
+            timeUntilAiring
+        }
+    ''',
+    # Local autocomplete title index
+    'titles': '''
+        id
+        title {
+            romaji
+            english
+            native
+        }
+    ''',
+    'detail': '''
+        id
+        title {
+            romaji
+            english
+            native
+        }
+        coverImage {
+            medium
+            large
+        }
+        bannerImage
+        episodes
+        status
+        season
+        seasonYear
+        genres
+        averageScore
+        popularity
+        nextAiringEpisode {
+            episode
+            airingAt
+            timeUntilAiring
+        }
+        description
+        studios(isMain: true) {
+            nodes {
+                name
+            }
+        }
+        externalLinks {
+            site
+            url
+        }
+        airingSchedule(notYetAired: true, page: 1, perPage: 1) {
+            nodes {
+                episode
+                airingAt
+            }
+        }
+    ''',
+}
+
+# Cached payloads of these profiles also contain every field of the key profile
+PROFILE_SUPERSETS = {
+    'list': ('poll', 'search', 'detail'),
+    'poll': ('search', 'detail'),
+    'search': ('detail',),
+    'titles': ('detail',),
+    'detail': (),
+}
+
+# Metadata cache lifetimes in seconds, chosen by how quickly each airing status goes stale
+FINISHED_TTL = 3 * 86400
+NOT_YET_RELEASED_TTL = 6 * 3600
+RELEASING_MAX_TTL = 6 * 3600
+DEFAULT_TTL = 3600
+MIN_TTL = 60
+SEARCH_TTL = 300
+SEARCH_CACHE_SIZE = 500
+
+ANILIST_REQUESTS = registry.counter('aira_anilist_requests_total', 'AniList HTTP requests by response status')
+ANILIST_LATENCY = registry.histogram('aira_anilist_request_seconds', 'AniList HTTP round trip time')
+ANILIST_COALESCED = registry.counter('aira_anilist_coalesced_total', 'AniList calls that joined a request already in flight')
+
+class RateLimiter:
+    """Token bucket that queues callers by priority and follows AniList's rate limit headers."""
+
+    def __init__(self, requests_per_minute: int = 90, burst: Optional[int] = None):
+        self.capacity = float(burst or requests_per_minute)
+        self.refill_rate = requests_per_minute / 60
+        self.tokens = self.capacity
+        self.blocked_until = 0.0
+        self._updated = time.monotonic()
+        self._waiters: List[tuple] = []
+        self._counter = itertools.count()
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.refill_rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = PRIORITY_BACKGROUND):
+        """Wait for a request slot. Lower priority values are served first."""
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._waiters:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+
+            now = time.monotonic()
+            self._refill(now)
+            delay = self.blocked_until - now
+            if delay <= 0 and self.tokens < 1:
+                delay = (1 - self.tokens) / self.refill_rate
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+
+            self.tokens -= 1
+            heapq.heappop(self._waiters)[2].set_result(None)
+
+    def update(self, status: int, headers) -> float:
+        """Sync the bucket with a response's rate limit headers and return the back-off in seconds."""
+        now = time.monotonic()
+        self._refill(now)
+
+        limit = headers.get('X-RateLimit-Limit', '')
+        if limit.isdigit() and int(limit) > 0:
+            self.capacity = float(limit)
+            self.refill_rate = int(limit) / 60
+
+        remaining = headers.get('X-RateLimit-Remaining', '')
+        if remaining.isdigit():
+            self.tokens = min(self.tokens, float(remaining))
+
+        if status != 429:
+            return 0.0
+
+        retry_after = headers.get('Retry-After', '')
+        delay = float(retry_after) if retry_after.isdigit() else float(DEFAULT_RETRY_AFTER)
+        self.tokens = 0.0
+        self.blocked_until = max(self.blocked_until, now + delay)
+        return delay
+
+class MetadataCache:
+    """Bounded LRU cache of Media payloads whose lifetime follows each show's airing status."""
+
+    def __init__(self, max_entries: int = 5000, releasing_max_ttl: float = RELEASING_MAX_TTL):
+        self.max_entries = max_entries
+        self.releasing_max_ttl = releasing_max_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Tuple[str, int], Tuple[float, Dict]] = OrderedDict()
+
+    def ttl_for(self, media: Dict, now: float) -> float:
+        status = media.get('status')
+        next_episode = media.get('nextAiringEpisode')
+        if status in ('FINISHED', 'CANCELLED'):
+            return FINISHED_TTL
+        if next_episode:
+            return max(MIN_TTL, min(next_episode['airingAt'] - now, self.releasing_max_ttl))
+        if status == 'NOT_YET_RELEASED':
+            return NOT_YET_RELEASED_TTL
+        return DEFAULT_TTL
+
+    def peek(self, kind: str, anime_id: int) -> Optional[Dict]:
+        """Look up an entry without counting a hit or miss."""
+        key = (kind, anime_id)
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, kinds: Tuple[str, ...], anime_id: int) -> Optional[Dict]:
+        """Return the first cached payload among kinds, counting one hit or miss for the lookup."""
+        for kind in kinds:
+            media = self.peek(kind, anime_id)
+            if media is not None:
+                self.hits += 1
+                return media
+        self.misses += 1
+        return None
+
+    def put(self, kind: str, media: Dict, expires_at: Optional[float] = None):
+        now = time.time()
+        key = (kind, media['id'])
+        # A persisted expiry never outlives the current TTL, which may have been lowered since
+        expires = now + self.ttl_for(media, now)
+        self._entries[key] = (min(expires, expires_at) if expires_at else expires, media)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def dump(self) -> List[Tuple[str, int, float, Dict]]:
+        """Return unexpired entries as (kind, anime_id, expires_at, media), oldest first."""
+        now = time.time()
+        return [(kind, anime_id, expires_at, media)
+                for (kind, anime_id), (expires_at, media) in self._entries.items() if expires_at > now]
+
+    def load(self, entries: List[Tuple[str, int, float, Dict]]):
+        now = time.time()
+        for kind, _, expires_at, media in entries:
+            if expires_at > now:
+                self.put(kind, media, expires_at)
+
+    def hit_ratio(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def __len__(self) -> int:
+        return len(self._entries)
 
 class AniListAPI:
-    @staticmethod
-    def _make_request(query: str, variables: Dict[str, Any]) -> Optional[Dict]:
-        """Make a request to the AniList API."""
-        response = requests.post(ANILIST_URL, json={'query': query, 'variables': variables})
-        if response.status_code == 200:
-            return response.json().get('data')
+    def __init__(self, timeout: float = 10.0, max_concurrency: int = 5, pool_size: int = 10,
+                 requests_per_minute: int = 90, cache_size: int = 5000,
+                 cache_max_ttl: float = RELEASING_MAX_TTL):
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.cache = MetadataCache(cache_size, cache_max_ttl)
+        self.pool_size = pool_size
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Single-flight: identical requests and IDs already being fetched share one upstream call
+        self._inflight: Dict[Tuple[str, str], asyncio.Task] = {}
+        self._inflight_ids: Dict[Tuple[str, int], asyncio.Future] = {}
+        self._search_cache: OrderedDict[Tuple[str, str], Tuple[float, List[Dict]]] = OrderedDict()
+        self.coalesced = 0
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared keep-alive session, creating it on first use."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def close(self):
+        """Close the underlying HTTP session."""
+        if self._session and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _make_request(self, query: str, variables: Dict[str, Any],
+                            priority: int = PRIORITY_BACKGROUND) -> Optional[Dict]:
+        """Make a request, joining an identical one that is already in flight."""
+        key = (query, json.dumps(variables, sort_keys=True))
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._send_request(query, variables, priority))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.coalesced += 1
+            ANILIST_COALESCED.inc()
+        # Shielded so one caller giving up does not cancel the request for everyone else
+        return await asyncio.shield(task)
+
+    async def _send_request(self, query: str, variables: Dict[str, Any],
+                            priority: int = PRIORITY_BACKGROUND) -> Optional[Dict]:
+        """Make a rate limited request to the AniList API, requeueing it when throttled."""
+        session = self._get_session()
+        for _ in range(MAX_RETRIES + 1):
+            await self.rate_limiter.acquire(priority)
+            async with self._semaphore:
+                try:
+                    start = time.perf_counter()
+                    async with session.post(ANILIST_URL, json={'query': query, 'variables': variables}) as response:
+                        ANILIST_LATENCY.observe(time.perf_counter() - start)
+                        ANILIST_REQUESTS.inc(status=response.status)
+                        retry_after = self.rate_limiter.update(response.status, response.headers)
+                        if response.status == 200:
+                            return (await response.json()).get('data')
+                        if response.status != 429:
+                            print(f"AniList request failed with status {response.status}")
+                            return None
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    ANILIST_REQUESTS.inc(status='error')
+                    print(f"AniList request failed: {str(e)}")
+                    return None
+            print(f"AniList rate limit reached, retrying in {retry_after:.0f}s")
+        return None
+
+    def _get_cached(self, profile: str, anime_id: int) -> Optional[Dict]:
+        return self.cache.get((profile, *PROFILE_SUPERSETS[profile]), anime_id)
+
+    def _get_inflight(self, profile: str, anime_id: int) -> Optional[asyncio.Future]:
+        for kind in (profile, *PROFILE_SUPERSETS[profile]):
+            future = self._inflight_ids.get((kind, anime_id))
+            if future is not None:
+                return future
         return None
 
-    def search_anime(self, search: str) -> List[Dict]:
+    async def search_anime(self, search: str, priority: int = PRIORITY_INTERACTIVE,
+                           profile: str = 'search') -> List[Dict]:
         """Search for anime with enhanced information."""
+        search = normalize_title(search)
+        key = (profile, search)
+        entry = self._search_cache.get(key)
+        if entry is not None and entry[0] > time.time():
+            self._search_cache.move_to_end(key)
+            return entry[1]
+
         query = '''
         query ($search: String) {
             Page(page: 1, perPage: 5) {
-                media(search: $search, type: ANIME) {
-                    id
-                    title {
-                        romaji
-                        english
-                        native
-                    }
-                    coverImage {
-                        medium
-                    }
-                    episodes
-                    status
-                    season
-                    seasonYear
-                    genres
-                    averageScore
-                    popularity
-                    nextAiringEpisode {
-                        episode
-                        airingAt
-                        timeUntilAiring
-                    }
-                    description
-                }
+                media(search: $search, type: ANIME) {%s}
             }
         }
-        '''
-        data = self._make_request(query, {'search': search})
-        return data['Page']['media'] if data else []
+        ''' % QUERY_PROFILES[profile]
+        data = await self._make_request(query, {'search': search}, priority)
+        if not data:
+            return []
+
+        media = data['Page']['media']
+        self._search_cache[key] = (time.time() + SEARCH_TTL, media)
+        self._search_cache.move_to_end(key)
+        while len(self._search_cache) > SEARCH_CACHE_SIZE:
+            self._search_cache.popitem(last=False)
+        return media
 
-    def get_anime_details(self, anime_id: int) -> Optional[Dict]:
+    async def get_anime_details(self, anime_id: int, priority: int = PRIORITY_INTERACTIVE,
+                                profile: str = 'detail') -> Optional[Dict]:
         """Get detailed information about an anime."""
+        cached = self._get_cached(profile, anime_id)
+        if cached:
+            return cached
+        inflight = self._get_inflight(profile, anime_id)
+        if inflight is not None:
+            self.coalesced += 1
+            ANILIST_COALESCED.inc()
+            return await asyncio.shield(inflight)
+
         query = '''
         query ($id: Int) {
-            Media(id: $id, type: ANIME) {
-                id
-                title {
-                    romaji
-                    english
-                    native
-                }
-                coverImage {
-                    medium
-                    large
+            Media(id: $id, type: ANIME) {%s}
+        }
+        ''' % QUERY_PROFILES[profile]
+        data = await self._make_request(query, {'id': anime_id}, priority)
+        if not data or not data['Media']:
+            return None
+        self.cache.put(profile, data['Media'])
+        return data['Media']
+
+    async def get_many_anime(self, anime_ids: List[int], priority: int = PRIORITY_BACKGROUND,
+                             profile: str = 'poll', not_found: Optional[Set[int]] = None) -> Dict[int, Dict]:
+        """Get information for many anime, one request per page of IDs.
+
+        IDs that a successful request returned nothing for (deleted or merged media) are added to not_found.
+        """
+        query = '''
+        query ($ids: [Int]) {
+            Page(page: 1, perPage: %d) {
+                media(id_in: $ids, type: ANIME) {%s}
+            }
+        }
+        ''' % (BATCH_SIZE, QUERY_PROFILES[profile])
+        results = {}
+        missing_ids = []
+        joined: Dict[int, asyncio.Future] = {}
+        for anime_id in dict.fromkeys(anime_ids):
+            cached = self._get_cached(profile, anime_id)
+            if cached:
+                results[anime_id] = cached
+                continue
+            inflight = self._get_inflight(profile, anime_id)
+            if inflight is not None:
+                joined[anime_id] = inflight
+            else:
+                missing_ids.append(anime_id)
+
+        loop = asyncio.get_running_loop()
+        futures = {}
+        for anime_id in missing_ids:
+            futures[anime_id] = self._inflight_ids[(profile, anime_id)] = loop.create_future()
+
+        try:
+            for start in range(0, len(missing_ids), BATCH_SIZE):
+                batch = missing_ids[start:start + BATCH_SIZE]
+                data = await self._make_request(query, {'ids': batch}, priority)
+                if not data:
+                    continue
+                for media in data['Page']['media']:
+                    self.cache.put(profile, media)
+                    results[media['id']] = media
+                if not_found is not None:
+                    not_found.update(anime_id for anime_id in batch if anime_id not in results)
+        finally:
+            for anime_id, future in futures.items():
+                self._inflight_ids.pop((profile, anime_id), None)
+                if not future.done():
+                    future.set_result(results.get(anime_id))
+
+        if joined:
+            self.coalesced += len(joined)
+            ANILIST_COALESCED.inc(len(joined))
+            for anime_id, media in zip(joined, await asyncio.gather(*(asyncio.shield(f) for f in joined.values()))):
+                if media:
+                    results[anime_id] = media
+        return results
+
+    async def get_aired_episodes(self, anime_ids: List[int], since: int, until: int,
+                                 priority: int = PRIORITY_BACKGROUND) -> Optional[List[Dict]]:
+        """Get every episode of the given anime that aired after since and up to until."""
+        query = '''
+        query ($ids: [Int], $since: Int, $until: Int, $page: Int) {
+            Page(page: $page, perPage: %d) {
+                pageInfo {
+                    hasNextPage
                 }
-                bannerImage
-                episodes
-                status
-                season
-                seasonYear
-                genres
-                averageScore
-                popularity
-                nextAiringEpisode {
+                airingSchedules(mediaId_in: $ids, airingAt_greater: $since, airingAt_lesser: $until, sort: TIME) {
                     episode
                     airingAt
-                    timeUntilAiring
-                }
-                description
-                studios(isMain: true) {
-                    nodes {
-                        name
-                    }
-                }
-                externalLinks {
-                    site
-                    url
+                    media {%s}
                 }
-                airingSchedule(notYetAired: true, page: 1, perPage: 1) {
-                    nodes {
-                        episode
-                        airingAt
-                    }
+            }
+        }
+        ''' % (BATCH_SIZE, QUERY_PROFILES['poll'])
+        variables = {'ids': list(dict.fromkeys(anime_ids)), 'since': since, 'until': until + 1, 'page': 1}
+        schedules = []
+        while True:
+            data = await self._make_request(query, variables, priority)
+            if not data:
+                return None
+            for schedule in data['Page']['airingSchedules']:
+                self.cache.put('poll', schedule['media'])
+            schedules.extend(data['Page']['airingSchedules'])
+            if not data['Page']['pageInfo']['hasNextPage']:
+                return schedules
+            variables['page'] += 1
+
+    async def get_current_titles(self, max_pages: int = 20, priority: int = PRIORITY_BACKGROUND) -> List[Dict]:
+        """Get the titles of airing and upcoming anime, most popular first."""
+        query = '''
+        query ($page: Int) {
+            Page(page: $page, perPage: %d) {
+                pageInfo {
+                    hasNextPage
                 }
+                media(type: ANIME, status_in: [RELEASING, NOT_YET_RELEASED], sort: POPULARITY_DESC) {%s}
             }
         }
-        '''
-        data = self._make_request(query, {'id': anime_id})
-        return data['Media'] if data else None
-
-    def format_time_until_airing(self, seconds: int) -> str:
-        """Format time until airing in a human-readable way."""
-        if seconds < 0:
-            return "already aired"
-            
-        days = seconds // 86400
-        hours = (seconds % 86400) // 3600
-        minutes = (seconds % 3600) // 60
-
-        parts = []
-        if days > 0:
-            parts.append(f"{days} day{'s' if days != 1 else ''}")
-        if hours > 0:
-            parts.append(f"{hours} hour{'s' if hours != 1 else ''}")
-        if minutes > 0 and days == 0:  # Only show minutes if less than a day
-            parts.append(f"{minutes} minute{'s' if minutes != 1 else ''}")
-
-        return ", ".join(parts)
+        ''' % (BATCH_SIZE, QUERY_PROFILES['titles'])
+        media = []
+        for page in range(1, max_pages + 1):
+            data = await self._make_request(query, {'page': page}, priority)
+            if not data:
+                break
+            media.extend(data['Page']['media'])
+            if not data['Page']['pageInfo']['hasNextPage']:
+                break
+        return media
 
     def format_airing_info(self, next_episode: Dict) -> str:
         """Format next episode airing information."""
         if not next_episode:
             return "No airing information available"
 
-        airing_time = datetime.fromtimestamp(next_episode['airingAt'])
-        time_until = self.format_time_until_airing(next_episode['timeUntilAiring'])
-        
+        # Discord renders the relative part at view time, so shared embeds never go stale
         return (f"Episode {next_episode['episode']} airs "
                 f"<t:{next_episode['airingAt']}:F> "
-                f"({time_until} from now)")
+                f"(<t:{next_episode['airingAt']}:R>)")
+
+    def get_latest_episode(self, anime_data: Dict) -> int:
+        """Return the most recent episode that has already aired."""
+        next_episode = anime_data.get('nextAiringEpisode')
+        if next_episode:
+            if next_episode['airingAt'] <= time.time():
+                return next_episode['episode']
+            return next_episode['episode'] - 1
+        if anime_data.get('status') == 'FINISHED':
+            return anime_data.get('episodes') or 0
+        return 0
 
     def get_episode_update_embed(self, anime_data: Dict, new_episode: int) -> Dict:
-        """Create a rich embed for episode updates."""
+        """Create the rich embed shared by every channel notified about an episode."""
         embed = {
-            "title": f"New Episode of {anime_data['title']['romaji']}!",
-            "description": f"Episode {new_episode} has been released!",
-            "color": 0x2E51A2,  # AniList's blue color
+            "title": "🎬 New Episode Available!",
+            "description": f"Episode {new_episode} of {anime_data['title']['romaji']} is now available!",
+            "color": 0x2ECC71,
             "fields": []
         }
 
         # Add English title if different
-        if (anime_data['title']['english'] and 
+        if (anime_data['title'].get('english') and
             anime_data['title']['english'] != anime_data['title']['romaji']):
             embed["fields"].append({
                 "name": "English Title",
@@ -155,11 +569,12 @@ class AniListAPI:
                 "inline": True
             })
 
-        # Add next episode info if available
-        if anime_data.get('nextAiringEpisode'):
+        # Add next episode info if it is not the one being announced
+        next_episode = anime_data.get('nextAiringEpisode')
+        if next_episode and next_episode['episode'] > new_episode:
             embed["fields"].append({
                 "name": "Next Episode",
-                "value": self.format_airing_info(anime_data['nextAiringEpisode']),
+                "value": self.format_airing_info(next_episode),
                 "inline": False
             })
 
@@ -167,4 +582,26 @@ class AniListAPI:
         if anime_data.get('coverImage', {}).get('medium'):
             embed["thumbnail"] = {"url": anime_data['coverImage']['medium']}
 
-        return embed 
\ No newline at end of file
+        return embed
+
+    def get_digest_embed(self, episodes: List[Tuple[Dict, int]]) -> Dict:
+        """Create one summary embed for a channel digest of (anime_data, episode) pairs."""
+        lines = []
+        for anime_data, episode in episodes:
+            title = anime_data['title'].get('english') or anime_data['title']['romaji']
+            total = f"/{anime_data['episodes']}" if anime_data.get('episodes') else ""
+            lines.append(f"**{title}** - Episode {episode}{total}")
+
+        description = ""
+        for index, line in enumerate(lines):
+            remaining = len(lines) - index
+            if len(description) + len(line) + 40 > 4096:
+                description += f"...and {remaining} more"
+                break
+            description += line + "\n"
+
+        return {
+            "title": f"🎬 {len(episodes)} New Episodes Available!",
+            "description": description.strip(),
+            "color": 0x2ECC71
+        }
@@ -0,0 +1,90 @@
+"""Local stand-in for the AniList GraphQL endpoint, used by the load test.
+
+It answers the query shapes AniListAPI sends with synthetic Media, enforces a
+per-minute request limit with AniList's rate limit headers and 429 Retry-After,
+and adds a fixed latency to every response.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Deque, Dict, List
+
+from aiohttp import web
+
+from synthetic_db import current_episode, show_title
+
+class AniListStub:
+    def __init__(self, requests_per_minute: int = 90, latency: float = 0.15, shows: int = 2000):
+        self.requests_per_minute = requests_per_minute
+        self.latency = latency
+        self.shows = shows
+        self.requests = 0
+        self.throttled = 0
+        self.url = None
+        self._recent: Deque[float] = deque()
+        self._runner = None
+
+    def media(self, anime_id: int) -> Dict:
+        now = int(time.time())
+        airing_at = now + 3600 + anime_id % 86400
+        return {
+            'id': anime_id,
+            'title': {'romaji': show_title(anime_id), 'english': f'Synthetic Show {anime_id}', 'native': None},
+            'coverImage': {'medium': f'https://example.invalid/cover/{anime_id}.jpg', 'large': None},
+            'episodes': 24,
+            'status': 'RELEASING',
+            'genres': ['Action', 'Fantasy'],
+            'averageScore': 70 + anime_id % 20,
+            'nextAiringEpisode': {
+                'episode': current_episode(anime_id) + 1,
+                'airingAt': airing_at,
+                'timeUntilAiring': airing_at - now,
+            },
+        }
+
+    def _answer(self, query: str, variables: Dict) -> Dict:
+        if 'ids' in variables:
+            return {'Page': {'media': [self.media(anime_id) for anime_id in variables['ids'] if 0 < anime_id <= self.shows]}}
+        if 'id' in variables:
+            return {'Media': self.media(variables['id']) if 0 < variables['id'] <= self.shows else None}
+        if 'search' in variables:
+            return {'Page': {'media': [self.media(anime_id) for anime_id in range(1, min(5, self.shows) + 1)]}}
+        if 'airingSchedules' in query:
+            return {'Page': {'pageInfo': {'hasNextPage': False}, 'airingSchedules': []}}
+        page: List[Dict] = [self.media(anime_id) for anime_id in range(1, min(50, self.shows) + 1)]
+        return {'Page': {'pageInfo': {'hasNextPage': False}, 'media': page}}
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        now = time.monotonic()
+        while self._recent and now - self._recent[0] >= 60:
+            self._recent.popleft()
+        headers = {'X-RateLimit-Limit': str(self.requests_per_minute)}
+        if len(self._recent) >= self.requests_per_minute:
+            self.throttled += 1
+            headers['X-RateLimit-Remaining'] = '0'
+            headers['Retry-After'] = str(int(60 - (now - self._recent[0])) + 1)
+            return web.json_response({'errors': [{'message': 'Too Many Requests.', 'status': 429}]}, status=429, headers=headers)
+
+        self._recent.append(now)
+        headers['X-RateLimit-Remaining'] = str(self.requests_per_minute - len(self._recent))
+        body = await request.json()
+        return web.json_response({'data': self._answer(body['query'], body.get('variables') or {})}, headers=headers)
+
+    async def start(self, host: str = '127.0.0.1', port: int = 0) -> str:
+        app = web.Application()
+        app.router.add_post('/', self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}/'
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,54 @@
+"""In-process stand-ins for the discord.py channels and guilds the notification path touches."""
+import asyncio
+from typing import Dict, List, Optional
+
+import discord
+
+class FakeGuild:
+    def __init__(self, guild_id: int):
+        self.id = guild_id
+        self.unavailable = False
+        self.me = None
+
+class FakeChannel:
+    """Records sends and sleeps for the configured latency instead of calling Discord."""
+
+    def __init__(self, channel_id: int, guild: FakeGuild, transport: 'FakeTransport'):
+        self.id = channel_id
+        self.guild = guild
+        self._transport = transport
+
+    def permissions_for(self, member) -> discord.Permissions:
+        return discord.Permissions(send_messages=True, embed_links=True)
+
+    async def send(self, content: Optional[str] = None, *, embed: Optional[discord.Embed] = None,
+                   embeds: Optional[List[discord.Embed]] = None):
+        await asyncio.sleep(self._transport.latency)
+        self._transport.messages += 1
+        self._transport.embeds += len(embeds) if embeds else 1
+
+class FakeTransport:
+    """Builds fake channels on demand, so it can stand in for Client.get_channel and get_guild."""
+
+    def __init__(self, guild_ids: Dict[str, Optional[int]], latency: float = 0.05):
+        self.latency = latency
+        self.messages = 0
+        self.embeds = 0
+        self._guild_ids = guild_ids
+        self._guilds: Dict[int, FakeGuild] = {}
+        self._channels: Dict[int, FakeChannel] = {}
+
+    def get_guild(self, guild_id: int) -> Optional[FakeGuild]:
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = FakeGuild(guild_id)
+        return guild
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        channel = self._channels.get(channel_id)
+        if channel is None:
+            guild_id = self._guild_ids.get(str(channel_id))
+            if guild_id is None:
+                return None
+            channel = self._channels[channel_id] = FakeChannel(channel_id, self.get_guild(guild_id), self)
+        return channel
@@ -0,0 +1,154 @@
+"""Offline load test of the notification path against a local AniList stub and fake Discord channels.
+
+Usage: python benchmarks/load_test.py [--subscriptions 100000] [--output results.json]
+
+Runs the real check_new_episodes and drain_outbox loop bodies from aira.py on a
+synthetic database and prints one JSON object, so results can be diffed across
+commits. The first tick runs with every free-tier slot due, the worst case after
+downtime, and a second tick measures the steady state.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from anilist_stub import AniListStub
+from fake_discord import FakeTransport
+from synthetic_db import FIRST_GUILD_ID, generate
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return ''
+
+async def run(args, db_path: str) -> dict:
+    import anilist_api
+    import aira
+    from database import Database
+
+    stub = AniListStub(requests_per_minute=args.rate_limit, latency=args.anilist_latency, shows=args.shows)
+    anilist_api.ANILIST_URL = await stub.start()
+
+    results = {'revision': git_revision(), 'config': vars(args)}
+    try:
+        aira.db = Database(db_path)
+        start = time.perf_counter()
+        await aira.db.init_db()
+        results['db_load_s'] = time.perf_counter() - start
+        results['subscriptions'] = len(aira.db.subscriptions)
+        results['channels'] = len(aira.db.subscriptions.channels)
+        results['shows'] = len(aira.db.subscriptions.by_anime)
+
+        transport = FakeTransport(
+            {channel_id: state.guild_id for channel_id, state in aira.db.subscriptions.channels.items()},
+            latency=args.send_latency
+        )
+        aira.bot.get_channel = transport.get_channel
+        aira.bot.get_guild = transport.get_guild
+
+        aira.DONATOR_SKU_ID = 'load-test'
+        guilds = {state.guild_id for state in aira.db.subscriptions.channels.values()}
+        for guild_id in guilds:
+            if (guild_id - FIRST_GUILD_ID) % 100 < args.donator_share * 100:
+                aira.donator_index.add(guild_id, guild_id)
+
+        aira.delivery.start()
+        aira.free_slot_minute = int(time.time() // 60) - aira.FREE_TIER_SLOTS
+
+        ticks = []
+        for _ in range(2):
+            requests_before = stub.requests
+            start = time.perf_counter()
+            await aira.check_new_episodes.coro()
+            tick_s = time.perf_counter() - start
+
+            start = time.perf_counter()
+            messages_before = aira.delivery.messages
+            while await aira.db.get_outbox_depth():
+                await aira.drain_outbox.coro()
+            drain_s = time.perf_counter() - start
+            messages = aira.delivery.messages - messages_before
+
+            ticks.append({
+                'tick_s': tick_s,
+                'upstream_requests': stub.requests - requests_before,
+                'messages': messages,
+                'drain_s': drain_s,
+                'messages_per_s': messages / drain_s if drain_s else 0.0,
+            })
+        results['cold_tick'], results['warm_tick'] = ticks
+
+        list_times = []
+        for channel_id in list(aira.db.subscriptions.channels)[:args.list_samples]:
+            start = time.perf_counter()
+            paginator = aira.AnimeListPaginator(await aira.db.get_channel_subscriptions(channel_id))
+            await paginator.load_current_page()
+            paginator.get_current_page_embed(None)
+            list_times.append(time.perf_counter() - start)
+
+        results['list_page_p50_ms'] = statistics.median(list_times) * 1000 if list_times else None
+        results['upstream_requests'] = stub.requests
+        results['upstream_throttled'] = stub.throttled
+        results['notifications_sent'] = aira.delivery.sent
+        results['notifications_failed'] = aira.delivery.failed
+        results['lag_p50_s'] = aira.delivery.lag_percentile(50)
+        results['lag_p99_s'] = aira.delivery.lag_percentile(99)
+        results['tick_overruns'] = aira.tick_stats['overruns']
+        results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    finally:
+        await aira.delivery.stop()
+        await aira.anilist.close()
+        await aira.db.close()
+        await stub.stop()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--shows', type=int, default=2000)
+    parser.add_argument('--db', help='existing synthetic database to use instead of generating one')
+    parser.add_argument('--new-episode-share', type=float, default=0.1)
+    parser.add_argument('--donator-share', type=float, default=0.1)
+    parser.add_argument('--rate-limit', type=int, default=90, help='stub requests per minute')
+    parser.add_argument('--anilist-latency', type=float, default=0.15, help='stub seconds per response')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='fake Discord seconds per send')
+    parser.add_argument('--sends-per-second', type=int, default=40)
+    parser.add_argument('--list-samples', type=int, default=50)
+    parser.add_argument('--output', help='also write the JSON results to this file')
+    args = parser.parse_args()
+
+    # aira.py reads its configuration at import time
+    os.environ['ANILIST_RATE_LIMIT'] = str(args.rate_limit)
+    os.environ['DELIVERY_SENDS_PER_SECOND'] = str(args.sends_per_second)
+    os.environ['DETECTION_MODE'] = 'schedule'
+    os.environ['PERSIST_ANIME_CACHE'] = 'false'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = args.db
+        if db_path is None:
+            db_path = os.path.join(tmp, 'aira.db')
+            generate(db_path, args.subscriptions, args.shows, new_episode_share=args.new_episode_share)
+        # The bot's own log lines go to stderr so stdout stays valid JSON
+        with contextlib.redirect_stdout(sys.stderr):
+            results = asyncio.run(run(args, db_path))
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""Compare response payload size and JSON decode time for each AniList query profile.
+
+Usage: python benchmarks/query_profiles.py [--pages 200] [--live]
+
+Offline, a representative Media payload is projected onto each profile's field
+selection. With --live, one page of 50 real shows is fetched per profile instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from anilist_api import ANILIST_URL, BATCH_SIZE, QUERY_PROFILES
+
+SAMPLE_IDS = [
+    154587, 145064, 153518, 166531, 163134, 151807, 158927, 166873, 161645, 170942,
+    21, 20, 1735, 235, 269, 813, 966, 1535, 5114, 9253,
+    11061, 16498, 20958, 21087, 21459, 101922, 113415, 127230, 131681, 140960,
+    142838, 143270, 146065, 147806, 150672, 151801, 153288, 154391, 155783, 156822,
+    159099, 160090, 161474, 162804, 163132, 164212, 165790, 166216, 167152, 168872,
+]
+
+def sample_media(anime_id: int) -> dict:
+    now = int(time.time())
+    return {
+        'id': anime_id,
+        'title': {
+            'romaji': 'Sousou no Frieren: Dai 2 Ki',
+            'english': "Frieren: Beyond Journey's End Season 2",
+            'native': '葬送のフリーレン 第2期',
+        },
+        'coverImage': {
+            'medium': f'https://s4.anilist.co/file/anilistcdn/media/anime/cover/small/bx{anime_id}-AbCdEfGhIjKl.jpg',
+            'large': f'https://s4.anilist.co/file/anilistcdn/media/anime/cover/medium/bx{anime_id}-AbCdEfGhIjKl.jpg',
+        },
+        'bannerImage': f'https://s4.anilist.co/file/anilistcdn/media/anime/banner/{anime_id}-MnOpQrStUvWx.jpg',
+        'episodes': 12,
+        'status': 'RELEASING',
+        'season': 'WINTER',
+        'seasonYear': 2026,
+        'genres': ['Adventure', 'Drama', 'Fantasy'],
+        'averageScore': 88,
+        'popularity': 412345,
+        'nextAiringEpisode': {'episode': 5, 'airingAt': now + 86400, 'timeUntilAiring': 86400},
+        'description': ('The adventure is over but life goes on for an elf mage just beginning to learn what '
+                        'living is all about. Elf mage Frieren and her courageous fellow adventurers have '
+                        'defeated the Demon King and brought peace to the land. <br><br>') * 6,
+        'studios': {'nodes': [{'name': 'MADHOUSE'}]},
+        'externalLinks': [
+            {'site': site, 'url': f'https://example.com/{site.lower()}/{anime_id}'}
+            for site in ('Official Site', 'Twitter', 'Crunchyroll', 'Netflix', 'YouTube', 'Bilibili TV', 'Hulu', 'Amazon')
+        ],
+        'airingSchedule': {'nodes': [{'episode': 5, 'airingAt': now + 86400}]},
+    }
+
+def parse_selection(selection: str) -> dict:
+    """Turn a GraphQL field selection into a nested {field: subselection-or-None} tree."""
+    tokens = re.findall(r'\([^)]*\)|[{}]|\w+', selection)
+    stack = [{}]
+    last = None
+    for token in tokens:
+        if token.startswith('('):
+            continue
+        if token == '{':
+            stack[-1][last] = {}
+            stack.append(stack[-1][last])
+        elif token == '}':
+            stack.pop()
+        else:
+            stack[-1][token] = None
+            last = token
+    return stack[0]
+
+def project(value, tree):
+    if tree is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    return {field: project(value.get(field), subtree) for field, subtree in tree.items()}
+
+def offline_payloads() -> dict:
+    payloads = {}
+    media = [sample_media(anime_id) for anime_id in SAMPLE_IDS[:BATCH_SIZE]]
+    for profile, selection in QUERY_PROFILES.items():
+        tree = parse_selection(selection)
+        page = {'data': {'Page': {'media': [project(item, tree) for item in media]}}}
+        payloads[profile] = json.dumps(page).encode()
+    return payloads
+
+async def live_payloads() -> dict:
+    import aiohttp
+
+    payloads = {}
+    async with aiohttp.ClientSession() as session:
+        for profile, selection in QUERY_PROFILES.items():
+            query = 'query ($ids: [Int]) { Page(page: 1, perPage: %d) { media(id_in: $ids, type: ANIME) {%s} } }' % (
+                BATCH_SIZE, selection)
+            async with session.post(ANILIST_URL, json={'query': query, 'variables': {'ids': SAMPLE_IDS}}) as response:
+                response.raise_for_status()
+                payloads[profile] = await response.read()
+            await asyncio.sleep(1)
+    return payloads
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--pages', type=int, default=200, help='decode repetitions per profile')
+    parser.add_argument('--live', action='store_true', help='fetch real payloads from AniList')
+    args = parser.parse_args()
+
+    payloads = asyncio.run(live_payloads()) if args.live else offline_payloads()
+
+    print(f"{'profile':<8} {'bytes/page':>11} {'bytes/show':>11} {'decode ms/page':>15}")
+    for profile, payload in payloads.items():
+        start = time.perf_counter()
+        for _ in range(args.pages):
+            json.loads(payload)
+        decode_ms = (time.perf_counter() - start) / args.pages * 1000
+        shows = len(json.loads(payload)['data']['Page']['media']) or 1
+        print(f'{profile:<8} {len(payload):>11,} {len(payload) // shows:>11,} {decode_ms:>15.3f}')
+
+if __name__ == '__main__':
+    main()
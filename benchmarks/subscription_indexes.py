@@ -0,0 +1,106 @@
+"""Compare subscription lookups before and after the indexed schema migration.
+
+Usage: python benchmarks/subscription_indexes.py [--rows 1000000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database
+
+UNINDEXED_QUERIES = {
+    'update_episodes': 'UPDATE subscriptions SET episodes = episodes WHERE anime_id = ?',
+    'remove_by_title': 'SELECT channel_id FROM subscriptions WHERE channel_id = ? AND LOWER(title) = LOWER(?)',
+}
+INDEXED_QUERIES = {
+    'update_episodes': 'UPDATE subscriptions SET episodes = episodes WHERE anime_id = ?',
+    'remove_by_title': 'SELECT channel_id FROM subscriptions WHERE channel_id = ? AND title_key = ?',
+}
+
+def create_legacy_db(path: str, rows: int, shows: int):
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE subscriptions (
+            channel_id TEXT,
+            anime_id INTEGER,
+            title TEXT,
+            episodes INTEGER DEFAULT 0,
+            PRIMARY KEY (channel_id, anime_id)
+        )
+    ''')
+    per_channel = min(shows, 10)
+    conn.executemany(
+        'INSERT INTO subscriptions VALUES (?, ?, ?, ?)',
+        (
+            (str(100000000000000000 + i // per_channel), (i * 7919) % shows + 1, f'Anime Title {(i * 7919) % shows + 1}', 0)
+            for i in range(rows)
+        )
+    )
+    conn.commit()
+    conn.close()
+
+def sample_params(path: str, samples: int, normalize: bool):
+    conn = sqlite3.connect(path)
+    rows = conn.execute('SELECT channel_id, anime_id, title FROM subscriptions ORDER BY RANDOM() LIMIT ?', (samples,)).fetchall()
+    conn.close()
+    return {
+        'update_episodes': [(anime_id,) for _, anime_id, _ in rows],
+        'remove_by_title': [(channel_id, title.casefold() if normalize else title.upper()) for channel_id, _, title in rows],
+    }
+
+def time_queries(path: str, queries: dict, params: dict) -> dict:
+    conn = sqlite3.connect(path)
+    results = {}
+    for name, sql in queries.items():
+        plan = ' / '.join(row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params[name][0]))
+        start = time.perf_counter()
+        for args in params[name]:
+            conn.execute(sql, args).fetchall()
+        conn.rollback()
+        elapsed = (time.perf_counter() - start) / len(params[name])
+        results[name] = (elapsed, plan)
+    conn.close()
+    return results
+
+async def migrate(path: str) -> float:
+    db = Database(path)
+    start = time.perf_counter()
+    await db.init_db()
+    elapsed = time.perf_counter() - start
+    await db.close()
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--shows', type=int, default=300)
+    parser.add_argument('--samples', type=int, default=50)
+    args = parser.parse_args()
+
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'aira.db')
+        print(f'Generating {args.rows:,} subscriptions across {args.shows} shows...')
+        create_legacy_db(path, args.rows, args.shows)
+
+        before = time_queries(path, UNINDEXED_QUERIES, sample_params(path, args.samples, normalize=False))
+        migration_time = asyncio.run(migrate(path))
+        after = time_queries(path, INDEXED_QUERIES, sample_params(path, args.samples, normalize=True))
+
+    print(f'Migration to indexed schema: {migration_time:.2f}s')
+    for name in UNINDEXED_QUERIES:
+        (old_time, old_plan), (new_time, new_plan) = before[name], after[name]
+        print(f'\n{name}')
+        print(f'  before: {old_time * 1000:9.3f} ms/query  [{old_plan}]')
+        print(f'  after:  {new_time * 1000:9.3f} ms/query  [{new_plan}]')
+        print(f'  speedup: {old_time / new_time:.1f}x')
+
+if __name__ == '__main__':
+    main()
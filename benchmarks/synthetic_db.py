@@ -0,0 +1,89 @@
+"""Generate a synthetic aira.db with the current schema for load testing.
+
+Usage: python benchmarks/synthetic_db.py out.db [--subscriptions 100000] [--shows 2000]
+
+Show popularity is skewed so a few shows have most of the subscribers, like the
+real bot. The stored episode of a --new-episode-share of shows is one behind what
+the AniList stub reports, so the first tick has notifications to send.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import Database, normalize_title
+
+FIRST_GUILD_ID = 900000000000000000
+FIRST_CHANNEL_ID = 100000000000000000
+
+def current_episode(anime_id: int) -> int:
+    """Latest aired episode of a synthetic show, shared with the AniList stub."""
+    return 1 + anime_id % 12
+
+def has_new_episode(anime_id: int, share: float) -> bool:
+    return (anime_id * 2654435761) % 1000 < share * 1000
+
+def show_title(anime_id: int) -> str:
+    return f'Synthetic Anime {anime_id}'
+
+async def _create_schema(path: str):
+    db = Database(path)
+    await db.init_db()
+    await db.close()
+
+def generate(path: str, subscriptions: int, shows: int = 2000, per_channel: int = 5,
+             channels_per_guild: int = 3, new_episode_share: float = 0.1, seed: int = 0) -> int:
+    """Fill path with roughly the requested number of subscriptions and return how many were written."""
+    asyncio.run(_create_schema(path))
+    rng = random.Random(seed)
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, shows + 1)))
+    channels = max(1, subscriptions // per_channel)
+
+    def rows():
+        for channel in range(channels):
+            channel_id = str(FIRST_CHANNEL_ID + channel)
+            guild_id = str(FIRST_GUILD_ID + channel // channels_per_guild)
+            for anime_id in set(rng.choices(range(1, shows + 1), cum_weights=cum_weights, k=per_channel)):
+                episode = current_episode(anime_id)
+                if has_new_episode(anime_id, new_episode_share):
+                    episode -= 1
+                title = show_title(anime_id)
+                yield channel_id, anime_id, title, episode, normalize_title(title), guild_id
+
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.executemany('''
+        INSERT OR IGNORE INTO subscriptions (channel_id, anime_id, title, episodes, title_key, guild_id)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows())
+    conn.commit()
+    written = conn.execute('SELECT COUNT(*) FROM subscriptions').fetchone()[0]
+    conn.close()
+    return written
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('path')
+    parser.add_argument('--subscriptions', type=int, default=100000)
+    parser.add_argument('--shows', type=int, default=2000)
+    parser.add_argument('--per-channel', type=int, default=5)
+    parser.add_argument('--channels-per-guild', type=int, default=3)
+    parser.add_argument('--new-episode-share', type=float, default=0.1)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        parser.error(f'{args.path} already exists')
+
+    start = time.perf_counter()
+    written = generate(args.path, args.subscriptions, args.shows, args.per_channel,
+                       args.channels_per_guild, args.new_episode_share)
+    print(f'Wrote {written:,} subscriptions to {args.path} in {time.perf_counter() - start:.1f}s')
+
+if __name__ == '__main__':
+    main()
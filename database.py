@@ -1,100 +1,491 @@
+import asyncio
+import json
+import time
+import unicodedata
 import aiosqlite
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+from subscription_index import SubscriptionIndex
+
+def normalize_title(title: str) -> str:
+    return ' '.join(unicodedata.normalize('NFKC', title).split()).casefold()
+
+# Each migration runs once, in order, inside its own transaction
+MIGRATIONS = [
+    (1, [
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            channel_id TEXT,
+            anime_id INTEGER,
+            title TEXT,
+            episodes INTEGER DEFAULT 0,
+            PRIMARY KEY (channel_id, anime_id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''',
+    ]),
+    (2, [
+        'ALTER TABLE subscriptions ADD COLUMN title_key TEXT',
+        'UPDATE subscriptions SET title_key = normalize_title(title) WHERE title IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_anime_id ON subscriptions (anime_id)',
+        'CREATE INDEX IF NOT EXISTS idx_subscriptions_title_key ON subscriptions (channel_id, title_key)',
+    ]),
+    (3, [
+        'ALTER TABLE subscriptions ADD COLUMN guild_id TEXT',
+    ]),
+    (4, [
+        '''
+        CREATE TABLE IF NOT EXISTS donator_entitlements (
+            entitlement_id TEXT PRIMARY KEY,
+            guild_id TEXT NOT NULL,
+            ends_at INTEGER
+        )
+        ''',
+    ]),
+    (5, [
+        '''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            channel_id TEXT NOT NULL,
+            anime_id INTEGER NOT NULL,
+            episode INTEGER NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 1,
+            created_at INTEGER NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            sent_at INTEGER,
+            PRIMARY KEY (channel_id, anime_id, episode)
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON notification_outbox (priority, created_at) WHERE sent_at IS NULL
+        ''',
+    ]),
+    (6, [
+        '''
+        CREATE TABLE IF NOT EXISTS anime_cache (
+            kind TEXT NOT NULL,
+            anime_id INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            data TEXT NOT NULL,
+            PRIMARY KEY (kind, anime_id)
+        )
+        ''',
+    ]),
+    (7, [
+        '''
+        CREATE TABLE IF NOT EXISTS anime_titles (
+            anime_id INTEGER PRIMARY KEY,
+            romaji TEXT NOT NULL,
+            english TEXT,
+            native TEXT
+        )
+        ''',
+    ]),
+    (8, [
+        '''
+        CREATE TABLE IF NOT EXISTS channel_settings (
+            channel_id TEXT PRIMARY KEY,
+            digest_window INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        # Digest channels hold their notifications until the window closes
+        'ALTER TABLE notification_outbox ADD COLUMN not_before INTEGER NOT NULL DEFAULT 0',
+    ]),
+]
+
+MAX_DELIVERY_ATTEMPTS = 5
+RETRY_BACKOFF = 30  # seconds, doubled after every failed attempt
 
 class Database:
     def __init__(self, db_path: str = 'aira.db'):
         self.db_path = db_path
+        self._db: Optional[aiosqlite.Connection] = None
+        self._write_lock = asyncio.Lock()
+        self.subscriptions = SubscriptionIndex()
+        self.digest_windows: Dict[str, int] = {}
 
     async def init_db(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                CREATE TABLE IF NOT EXISTS subscriptions (
-                    channel_id TEXT,
-                    anime_id INTEGER,
-                    title TEXT,
-                    episodes INTEGER DEFAULT 0,
-                    PRIMARY KEY (channel_id, anime_id)
-                )
-            ''')
-            await db.commit()
-
-    async def add_subscription(self, channel_id: str, anime_id: int, title: str, episodes: int = 0):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                INSERT OR REPLACE INTO subscriptions 
-                (channel_id, anime_id, title, episodes)
-                VALUES (?, ?, ?, ?)
-            ''', (channel_id, anime_id, title, episodes))
-            await db.commit()
+        if self._db is None:
+            # One long-lived connection keeps sqlite3's prepared statement cache warm between calls
+            self._db = await aiosqlite.connect(self.db_path, cached_statements=256)
+            await self._db.execute('PRAGMA journal_mode = WAL')
+            await self._db.execute('PRAGMA synchronous = NORMAL')
+            await self._db.create_function('normalize_title', 1, normalize_title, deterministic=True)
+
+        async with self._write_lock:
+            await self._migrate()
+
+        async with self._db.execute('''
+            SELECT channel_id, anime_id, episodes, guild_id
+            FROM subscriptions
+        ''') as cursor:
+            self.subscriptions.load(await cursor.fetchall())
+
+        async with self._db.execute('SELECT channel_id, digest_window FROM channel_settings') as cursor:
+            self.digest_windows = {channel_id: window for channel_id, window in await cursor.fetchall() if window}
+
+    async def _migrate(self):
+        await self._db.execute('''
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                applied_at INTEGER
+            )
+        ''')
+        async with self._db.execute('SELECT COALESCE(MAX(version), 0) FROM schema_migrations') as cursor:
+            current_version = (await cursor.fetchone())[0]
+
+        for version, statements in MIGRATIONS:
+            if version <= current_version:
+                continue
+            try:
+                await self._db.execute('BEGIN')
+                for statement in statements:
+                    await self._db.execute(statement)
+                await self._db.execute('''
+                    INSERT INTO schema_migrations (version, applied_at)
+                    VALUES (?, ?)
+                ''', (version, int(time.time())))
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+
+    async def close(self):
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+    async def add_subscription(self, channel_id: str, anime_id: int, title: str, episodes: int = 0,
+                               guild_id: Optional[int] = None):
+        async with self._write_lock:
+            await self._db.execute('''
+                INSERT OR REPLACE INTO subscriptions
+                (channel_id, anime_id, title, title_key, episodes, guild_id)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (channel_id, anime_id, title, normalize_title(title), episodes,
+                  str(guild_id) if guild_id else None))
+            await self._db.commit()
+            self.subscriptions.add(channel_id, anime_id, episodes, guild_id)
 
     async def remove_subscription(self, channel_id: str, anime_id: int) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                DELETE FROM subscriptions 
-                WHERE channel_id = ? AND anime_id = ?
-                RETURNING *
-            ''', (channel_id, anime_id))
-            deleted = await cursor.fetchone()
-            await db.commit()
+        async with self._write_lock:
+            try:
+                cursor = await self._db.execute('''
+                    DELETE FROM subscriptions
+                    WHERE channel_id = ? AND anime_id = ?
+                    RETURNING anime_id
+                ''', (channel_id, anime_id))
+                deleted = await cursor.fetchone()
+                await cursor.close()
+                await self._db.execute('''
+                    DELETE FROM notification_outbox
+                    WHERE channel_id = ? AND anime_id = ? AND sent_at IS NULL
+                ''', (channel_id, anime_id))
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            self.subscriptions.remove(channel_id, anime_id)
             return deleted is not None
 
     async def remove_subscription_by_title(self, channel_id: str, title: str) -> bool:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                DELETE FROM subscriptions 
-                WHERE channel_id = ? AND LOWER(title) = LOWER(?)
-                RETURNING *
-            ''', (channel_id, title))
-            deleted = await cursor.fetchone()
-            await db.commit()
-            return deleted is not None
+        async with self._write_lock:
+            try:
+                cursor = await self._db.execute('''
+                    DELETE FROM subscriptions
+                    WHERE channel_id = ? AND title_key = ?
+                    RETURNING anime_id
+                ''', (channel_id, normalize_title(title)))
+                deleted = await cursor.fetchall()
+                await cursor.close()
+                await self._db.executemany('''
+                    DELETE FROM notification_outbox
+                    WHERE channel_id = ? AND anime_id = ? AND sent_at IS NULL
+                ''', [(channel_id, row[0]) for row in deleted])
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            for row in deleted:
+                self.subscriptions.remove(channel_id, row[0])
+            return len(deleted) > 0
 
     async def remove_all_subscriptions(self, channel_id: str) -> int:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                DELETE FROM subscriptions 
-                WHERE channel_id = ?
-                RETURNING *
-            ''', (channel_id,))
-            deleted = await cursor.fetchall()
-            await db.commit()
+        async with self._write_lock:
+            try:
+                cursor = await self._db.execute('''
+                    DELETE FROM subscriptions
+                    WHERE channel_id = ?
+                    RETURNING anime_id
+                ''', (channel_id,))
+                deleted = await cursor.fetchall()
+                await cursor.close()
+                await self._db.execute('''
+                    DELETE FROM notification_outbox
+                    WHERE channel_id = ? AND sent_at IS NULL
+                ''', (channel_id,))
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            self.subscriptions.remove_channel(channel_id)
             return len(deleted)
 
+    async def remove_channels(self, channel_ids: List[str]) -> Tuple[int, int]:
+        # Returns (subscriptions removed, shows nobody is subscribed to anymore)
+        channel_ids = list(dict.fromkeys(channel_ids))
+        if not channel_ids:
+            return 0, 0
+        async with self._write_lock:
+            try:
+                cursor = await self._db.executemany('''
+                    DELETE FROM subscriptions
+                    WHERE channel_id = ?
+                ''', [(channel_id,) for channel_id in channel_ids])
+                removed = cursor.rowcount
+                await self._db.executemany('''
+                    DELETE FROM notification_outbox
+                    WHERE channel_id = ? AND sent_at IS NULL
+                ''', [(channel_id,) for channel_id in channel_ids])
+                await self._db.executemany('''
+                    DELETE FROM channel_settings
+                    WHERE channel_id = ?
+                ''', [(channel_id,) for channel_id in channel_ids])
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            anime_ids = set()
+            for channel_id in channel_ids:
+                self.digest_windows.pop(channel_id, None)
+                anime_ids.update(self.subscriptions.remove_channel(channel_id))
+            return removed, sum(1 for anime_id in anime_ids if not self.subscriptions.subscribers(anime_id))
+
     async def get_channel_subscriptions(self, channel_id: str) -> List[Dict]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT anime_id as id, title, episodes 
-                FROM subscriptions 
-                WHERE channel_id = ?
-            ''', (channel_id,))
+        async with self._db.execute('''
+            SELECT anime_id as id, title, episodes
+            FROM subscriptions
+            WHERE channel_id = ?
+        ''', (channel_id,)) as cursor:
             rows = await cursor.fetchall()
-            return [{'id': row[0], 'title': row[1], 'episodes': row[2]} for row in rows]
-
-    async def get_all_subscriptions(self) -> Dict[str, List[Dict]]:
-        async with aiosqlite.connect(self.db_path) as db:
-            cursor = await db.execute('''
-                SELECT channel_id, anime_id as id, title, episodes 
-                FROM subscriptions
-            ''')
+        return [{'id': row[0], 'title': row[1], 'episodes': row[2]} for row in rows]
+
+    async def enqueue_notifications(self, notifications: List[Tuple[str, int, int, int]]):
+        # (channel_id, anime_id, episode) is the idempotency key, re-detecting an episode never queues it twice
+        if not notifications:
+            return
+        now = int(time.time())
+        async with self._write_lock:
+            try:
+                await self._db.executemany('''
+                    INSERT OR IGNORE INTO notification_outbox (channel_id, anime_id, episode, priority, created_at, not_before)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                ''', [(channel_id, anime_id, episode, priority, now, now + self.digest_windows.get(channel_id, 0))
+                      for channel_id, anime_id, episode, priority in notifications])
+                await self._db.executemany('''
+                    UPDATE subscriptions
+                    SET episodes = MAX(COALESCE(episodes, 0), ?)
+                    WHERE channel_id = ? AND anime_id = ?
+                ''', [(episode, channel_id, anime_id) for channel_id, anime_id, episode, _ in notifications])
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            for channel_id, anime_id, episode, _ in notifications:
+                self.subscriptions.set_episodes(channel_id, anime_id, episode)
+
+    async def get_pending_notifications(self, limit: int) -> List[Tuple[str, int, int, int, int]]:
+        # Once a channel's digest window closes, everything it has pending goes out together
+        now = int(time.time())
+        async with self._db.execute('''
+            SELECT channel_id, anime_id, episode, priority, created_at
+            FROM notification_outbox
+            WHERE sent_at IS NULL AND attempts < ? AND (
+                not_before <= ?
+                OR channel_id IN (
+                    SELECT channel_id FROM notification_outbox
+                    WHERE sent_at IS NULL AND attempts < ? AND not_before <= ?
+                )
+            )
+            ORDER BY priority, created_at
+            LIMIT ?
+        ''', (MAX_DELIVERY_ATTEMPTS, now, MAX_DELIVERY_ATTEMPTS, now, limit)) as cursor:
+            return list(await cursor.fetchall())
+
+    async def get_next_due_at(self) -> Optional[int]:
+        async with self._db.execute('''
+            SELECT MIN(not_before) FROM notification_outbox
+            WHERE sent_at IS NULL AND attempts < ?
+        ''', (MAX_DELIVERY_ATTEMPTS,)) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def complete_notifications(self, sent: List[Tuple[str, int, int]], failed: List[Tuple[str, int, int]],
+                                     deferred: List[Tuple[str, int, int]] = (),
+                                     discarded: List[Tuple[str, int, int]] = ()):
+        # Failed rows back off exponentially, deferred rows (channel not cached yet) retry later without using an attempt,
+        # discarded rows (subscription gone) are dropped
+        if not sent and not failed and not deferred and not discarded:
+            return
+        now = int(time.time())
+        async with self._write_lock:
+            await self._db.executemany('''
+                UPDATE notification_outbox
+                SET sent_at = ?, attempts = attempts + 1
+                WHERE channel_id = ? AND anime_id = ? AND episode = ?
+            ''', [(now, *key) for key in sent])
+            await self._db.executemany('''
+                UPDATE notification_outbox
+                SET attempts = attempts + 1, not_before = ? + ? * (1 << attempts)
+                WHERE channel_id = ? AND anime_id = ? AND episode = ?
+            ''', [(now, RETRY_BACKOFF, *key) for key in failed])
+            await self._db.executemany('''
+                UPDATE notification_outbox
+                SET not_before = ?
+                WHERE channel_id = ? AND anime_id = ? AND episode = ?
+            ''', [(now + RETRY_BACKOFF, *key) for key in deferred])
+            await self._db.executemany('''
+                DELETE FROM notification_outbox
+                WHERE channel_id = ? AND anime_id = ? AND episode = ? AND sent_at IS NULL
+            ''', discarded)
+            await self._db.commit()
+
+    async def get_outbox_depth(self) -> int:
+        async with self._db.execute('''
+            SELECT COUNT(*) FROM notification_outbox
+            WHERE sent_at IS NULL AND attempts < ?
+        ''', (MAX_DELIVERY_ATTEMPTS,)) as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def prune_outbox(self, sent_before: int) -> int:
+        # Rows that used up their delivery attempts are kept for the same retention, then dropped
+        async with self._write_lock:
+            cursor = await self._db.execute('''
+                DELETE FROM notification_outbox
+                WHERE (sent_at IS NOT NULL AND sent_at < ?)
+                   OR (sent_at IS NULL AND attempts >= ? AND created_at < ?)
+            ''', (sent_before, MAX_DELIVERY_ATTEMPTS, sent_before))
+            deleted = cursor.rowcount
+            await cursor.close()
+            await self._db.commit()
+            return deleted
+
+    async def set_digest_window(self, channel_id: str, seconds: int):
+        async with self._write_lock:
+            try:
+                await self._db.execute('''
+                    INSERT INTO channel_settings (channel_id, digest_window)
+                    VALUES (?, ?)
+                    ON CONFLICT(channel_id) DO UPDATE SET digest_window = excluded.digest_window
+                ''', (channel_id, seconds))
+                # Rows held under a longer or disabled window follow the new one
+                await self._db.execute('''
+                    UPDATE notification_outbox
+                    SET not_before = MIN(not_before, created_at + ?)
+                    WHERE channel_id = ? AND sent_at IS NULL
+                ''', (seconds, channel_id))
+                await self._db.commit()
+            except Exception:
+                await self._db.rollback()
+                raise
+            if seconds:
+                self.digest_windows[channel_id] = seconds
+            else:
+                self.digest_windows.pop(channel_id, None)
+
+    async def set_channel_guild(self, channel_id: str, guild_id: int):
+        async with self._write_lock:
+            await self._db.execute('''
+                UPDATE subscriptions
+                SET guild_id = ?
+                WHERE channel_id = ?
+            ''', (str(guild_id), channel_id))
+            await self._db.commit()
+            state = self.subscriptions.channels.get(channel_id)
+            if state is not None:
+                state.guild_id = guild_id
+
+    async def get_state(self, key: str) -> Optional[str]:
+        async with self._db.execute('''
+            SELECT value FROM bot_state WHERE key = ?
+        ''', (key,)) as cursor:
+            row = await cursor.fetchone()
+        return row[0] if row else None
+
+    async def set_state(self, key: str, value: str):
+        async with self._write_lock:
+            await self._db.execute('''
+                INSERT OR REPLACE INTO bot_state (key, value)
+                VALUES (?, ?)
+            ''', (key, value))
+            await self._db.commit()
+
+    async def get_donator_entitlements(self) -> List[Tuple[str, str, Optional[int]]]:
+        async with self._db.execute('''
+            SELECT entitlement_id, guild_id, ends_at
+            FROM donator_entitlements
+        ''') as cursor:
+            return list(await cursor.fetchall())
+
+    async def save_donator_entitlement(self, entitlement_id: int, guild_id: int, ends_at: Optional[int]):
+        async with self._write_lock:
+            await self._db.execute('''
+                INSERT OR REPLACE INTO donator_entitlements (entitlement_id, guild_id, ends_at)
+                VALUES (?, ?, ?)
+            ''', (str(entitlement_id), str(guild_id), ends_at))
+            await self._db.commit()
+
+    async def remove_donator_entitlement(self, entitlement_id: int):
+        async with self._write_lock:
+            await self._db.execute('''
+                DELETE FROM donator_entitlements WHERE entitlement_id = ?
+            ''', (str(entitlement_id),))
+            await self._db.commit()
+
+    async def replace_donator_entitlements(self, entitlements: List[Tuple[int, int, Optional[int]]]):
+        async with self._write_lock:
+            await self._db.execute('DELETE FROM donator_entitlements')
+            await self._db.executemany('''
+                INSERT OR REPLACE INTO donator_entitlements (entitlement_id, guild_id, ends_at)
+                VALUES (?, ?, ?)
+            ''', [(str(entitlement_id), str(guild_id), ends_at) for entitlement_id, guild_id, ends_at in entitlements])
+            await self._db.commit()
+
+    async def get_cached_anime(self) -> List[Tuple[str, int, float, Dict]]:
+        async with self._db.execute('''
+            SELECT kind, anime_id, expires_at, data
+            FROM anime_cache
+            WHERE expires_at > ?
+        ''', (time.time(),)) as cursor:
             rows = await cursor.fetchall()
-            
-            result = {}
-            for row in rows:
-                channel_id = row[0]
-                if channel_id not in result:
-                    result[channel_id] = []
-                result[channel_id].append({
-                    'id': row[1],
-                    'title': row[2],
-                    'episodes': row[3]
-                })
-            return result
-
-    async def update_episodes(self, anime_id: int, episodes: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute('''
-                UPDATE subscriptions 
-                SET episodes = ? 
-                WHERE anime_id = ?
-            ''', (episodes, anime_id))
-            await db.commit() 
\ No newline at end of file
+        return [(kind, anime_id, expires_at, json.loads(data)) for kind, anime_id, expires_at, data in rows]
+
+    async def save_cached_anime(self, entries: List[Tuple[str, int, float, Dict]]):
+        async with self._write_lock:
+            await self._db.execute('DELETE FROM anime_cache')
+            await self._db.executemany('''
+                INSERT OR REPLACE INTO anime_cache (kind, anime_id, expires_at, data)
+                VALUES (?, ?, ?, ?)
+            ''', [(kind, anime_id, expires_at, json.dumps(media)) for kind, anime_id, expires_at, media in entries])
+            await self._db.commit()
+
+    async def get_anime_titles(self) -> List[Tuple[int, str, Optional[str], Optional[str]]]:
+        async with self._db.execute('''
+            SELECT anime_id, romaji, english, native FROM anime_titles
+            UNION ALL
+            SELECT anime_id, MIN(title), NULL, NULL FROM subscriptions
+            WHERE anime_id NOT IN (SELECT anime_id FROM anime_titles)
+            GROUP BY anime_id
+        ''') as cursor:
+            return list(await cursor.fetchall())
+
+    async def save_anime_titles(self, titles: List[Tuple[int, str, Optional[str], Optional[str]]]):
+        async with self._write_lock:
+            await self._db.executemany('''
+                INSERT OR REPLACE INTO anime_titles (anime_id, romaji, english, native)
+                VALUES (?, ?, ?, ?)
+            ''', titles)
+            await self._db.commit()
@@ -0,0 +1,137 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Set, Tuple, Union
+
+import discord
+
+from anilist_api import RateLimiter
+from metrics import registry
+
+PRIORITY_DONATOR = 0
+PRIORITY_FREE = 1
+
+SEND_LATENCY = registry.histogram('aira_discord_send_seconds', 'Discord message send time, including discord.py rate limit waits')
+SEND_RESULTS = registry.counter('aira_discord_sends_total', 'Discord message sends by outcome')
+
+class Notification:
+    __slots__ = ('channel', 'channel_id', 'anime_id', 'episode', 'embed', 'queued_at')
+
+    def __init__(self, channel: discord.abc.Messageable, channel_id: str, anime_id: int, episode: int,
+                 embed: discord.Embed, queued_at: Optional[float] = None):
+        self.channel = channel
+        self.channel_id = channel_id
+        self.anime_id = anime_id
+        self.episode = episode
+        self.embed = embed
+        self.queued_at = time.time() if queued_at is None else queued_at
+
+    @property
+    def key(self) -> Tuple[str, int, int]:
+        return (self.channel_id, self.anime_id, self.episode)
+
+    @property
+    def keys(self) -> List[Tuple[str, int, int]]:
+        return [self.key]
+
+    async def send(self):
+        await self.channel.send(embed=self.embed)
+
+class Digest:
+    """Several notifications for one channel sent as a single message."""
+    __slots__ = ('channel', 'channel_id', 'keys', 'embeds', 'queued_at')
+
+    def __init__(self, channel: discord.abc.Messageable, channel_id: str, keys: List[Tuple[str, int, int]],
+                 embeds: List[discord.Embed], queued_at: Optional[float] = None):
+        self.channel = channel
+        self.channel_id = channel_id
+        self.keys = keys
+        self.embeds = embeds
+        self.queued_at = time.time() if queued_at is None else queued_at
+
+    async def send(self):
+        await self.channel.send(embeds=self.embeds)
+
+class DeliveryPipeline:
+    """Bounded worker pool that sends notifications claimed from the outbox, recording each result as it finishes."""
+
+    def __init__(self, workers: int = 8, sends_per_second: int = 40, lag_samples: int = 1000):
+        self.workers = workers
+        self.limiter = RateLimiter(requests_per_minute=sends_per_second * 60, burst=sends_per_second)
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.lags: Deque[float] = deque(maxlen=lag_samples)
+        self.sent = 0
+        self.failed = 0
+        self.messages = 0
+        self._counter = itertools.count()
+        self._sent_keys: List[Tuple[str, int, int]] = []
+        self._failed_keys: List[Tuple[str, int, int]] = []
+        self._unreachable: Dict[str, bool] = {}
+        # Keys queued or sent but not yet persisted, so the outbox never hands them out twice
+        self.in_flight: Set[Tuple[str, int, int]] = set()
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def put(self, notification: Union[Notification, Digest], priority: int = PRIORITY_FREE):
+        self.in_flight.update(notification.keys)
+        self.queue.put_nowait((priority, next(self._counter), notification))
+
+    def release(self, keys: List[Tuple[str, int, int]]):
+        """Forget finished keys once their outcome has been persisted."""
+        self.in_flight.difference_update(keys)
+
+    def take_results(self) -> Tuple[List[Tuple[str, int, int]], List[Tuple[str, int, int]]]:
+        """Return and clear the sent and failed notification keys since the last call."""
+        sent, self._sent_keys = self._sent_keys, []
+        failed, self._failed_keys = self._failed_keys, []
+        return sent, failed
+
+    def take_unreachable(self) -> Dict[str, bool]:
+        """Return and clear channels that rejected a send, mapped to True if the channel is gone for good."""
+        unreachable, self._unreachable = self._unreachable, {}
+        return unreachable
+
+    def lag_percentile(self, percentile: float) -> Optional[float]:
+        if not self.lags:
+            return None
+        ordered = sorted(self.lags)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * percentile / 100))]
+
+    async def _worker(self):
+        while True:
+            _, _, notification = await self.queue.get()
+            try:
+                # discord.py handles per-route buckets itself, pacing here keeps us under the global limit
+                await self.limiter.acquire()
+                with SEND_LATENCY.time():
+                    await notification.send()
+                SEND_RESULTS.inc(result='sent')
+                self.lags.append(time.time() - notification.queued_at)
+                self.messages += 1
+                self.sent += len(notification.keys)
+                self._sent_keys.extend(notification.keys)
+            except (discord.NotFound, discord.Forbidden) as e:
+                SEND_RESULTS.inc(result=type(e).__name__.lower())
+                self.failed += len(notification.keys)
+                self._failed_keys.extend(notification.keys)
+                self._unreachable[notification.channel_id] = (
+                    self._unreachable.get(notification.channel_id, False) or isinstance(e, discord.NotFound)
+                )
+            except Exception as e:
+                rate_limited = isinstance(e, discord.HTTPException) and e.status == 429
+                SEND_RESULTS.inc(result='rate_limited' if rate_limited else 'error')
+                self.failed += len(notification.keys)
+                self._failed_keys.extend(notification.keys)
+                print(f"Error delivering {len(notification.keys)} notifications to channel {notification.channel_id}: {str(e)}")
+            finally:
+                self.queue.task_done()
@@ -0,0 +1,167 @@
+import asyncio
+import cProfile
+import contextvars
+import functools
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from typing import Dict, List, Optional, TextIO
+
+_current_span: contextvars.ContextVar = contextvars.ContextVar('diagnostics_span', default=None)
+
+class Diagnostics:
+    """Opt-in structured JSON-lines diagnostics: event-loop stalls, command spans and on-demand profiles."""
+
+    def __init__(self, enabled: bool = False, path: Optional[str] = None, block_ms: float = 100,
+                 profile_dir: str = '.'):
+        self.enabled = enabled
+        self.block_threshold = block_ms / 1000
+        self.profile_dir = profile_dir
+        self._path = path
+        self._output: Optional[TextIO] = None
+        self._lock = threading.Lock()
+        self._heartbeat = time.monotonic()
+        self._heartbeat_interval = self.block_threshold / 4
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        self._watchdog: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self._profiler: Optional[cProfile.Profile] = None
+        self._profile_started = 0.0
+
+    def emit(self, event: str, **fields):
+        if not self.enabled:
+            return
+        line = json.dumps({'ts': time.time(), 'event': event, **fields}, default=str)
+        with self._lock:
+            if self._output is None:
+                self._output = open(self._path, 'a', buffering=1) if self._path else sys.stderr
+            self._output.write(line + '\n')
+
+    # Event loop blocking monitor
+
+    async def _beat(self):
+        while True:
+            self._heartbeat = time.monotonic()
+            await asyncio.sleep(self._heartbeat_interval)
+
+    def _watch(self, loop_thread_id: int):
+        reported_at = None
+        while not self._stop.wait(self._heartbeat_interval):
+            heartbeat = self._heartbeat
+            stalled = time.monotonic() - heartbeat - self._heartbeat_interval
+            if stalled >= self.block_threshold and reported_at != heartbeat:
+                # Sample the loop thread while it is still stuck, that frame is the culprit
+                frame = sys._current_frames().get(loop_thread_id)
+                stack = traceback.format_stack(frame)[-15:] if frame is not None else []
+                self.emit('loop_blocked', blocked_ms=round(stalled * 1000, 1),
+                          stack=[line.strip() for line in stack])
+                reported_at = heartbeat
+            elif reported_at is not None and reported_at != heartbeat:
+                self.emit('loop_unblocked', blocked_ms=round((heartbeat - reported_at - self._heartbeat_interval) * 1000, 1))
+                reported_at = None
+
+    def start(self):
+        """Start the loop monitor, must be called from the event loop thread."""
+        if not self.enabled or self._heartbeat_task is not None:
+            return
+        self._stop.clear()
+        self._heartbeat = time.monotonic()
+        self._heartbeat_task = asyncio.create_task(self._beat())
+        self._watchdog = threading.Thread(target=self._watch, args=(threading.get_ident(),),
+                                          name='diagnostics-watchdog', daemon=True)
+        self._watchdog.start()
+        self.emit('diagnostics_started', block_ms=self.block_threshold * 1000)
+
+    async def stop(self):
+        if self._heartbeat_task is not None:
+            self._heartbeat_task.cancel()
+            await asyncio.gather(self._heartbeat_task, return_exceptions=True)
+            self._heartbeat_task = None
+        self._stop.set()
+        if self._profiler is not None:
+            self.stop_profile()
+        if self._output is not None and self._output is not sys.stderr:
+            self._output.close()
+        self._output = None
+
+    # Per-command latency spans
+
+    def traced(self, name: str):
+        """Record a span around a command callback, phase() calls inside it add to its breakdown."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                phases: Dict[str, float] = {}
+                token = _current_span.set(phases)
+                start = time.perf_counter()
+                error = None
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as e:
+                    error = repr(e)
+                    raise
+                finally:
+                    _current_span.reset(token)
+                    self.emit('command', command=name, total_ms=round((time.perf_counter() - start) * 1000, 2),
+                              phases={phase: round(ms, 2) for phase, ms in phases.items()}, error=error)
+            return wrapper
+        return decorator
+
+    @staticmethod
+    @contextmanager
+    def phase(name: str):
+        phases = _current_span.get()
+        if phases is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases[name] = phases.get(name, 0.0) + (time.perf_counter() - start) * 1000
+
+    # On-demand profiling
+
+    @property
+    def profiling(self) -> bool:
+        return self._profiler is not None
+
+    def start_profile(self) -> bool:
+        if self._profiler is not None:
+            return False
+        self._profiler = cProfile.Profile()
+        self._profile_started = time.time()
+        self._profiler.enable()
+        self.emit('profile_started')
+        return True
+
+    def stop_profile(self, top: int = 25) -> Optional[str]:
+        """Stop profiling, write the .prof file and emit the top functions by cumulative time."""
+        if self._profiler is None:
+            return None
+        profiler, self._profiler = self._profiler, None
+        profiler.disable()
+
+        path = os.path.join(self.profile_dir, f'aira-{int(self._profile_started)}.prof')
+        profiler.dump_stats(path)
+        stats = pstats.Stats(profiler)
+        rows: List[Dict] = []
+        for (filename, line, function), (_, calls, tottime, cumtime, _) in sorted(
+                stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]:
+            rows.append({'function': f'{filename}:{line}({function})', 'calls': calls,
+                         'tottime_ms': round(tottime * 1000, 2), 'cumtime_ms': round(cumtime * 1000, 2)})
+        self.emit('profile', duration_s=round(time.time() - self._profile_started, 2), path=path, top=rows)
+        return path
+
+    def toggle_profile(self):
+        if self.profiling:
+            self.stop_profile()
+        else:
+            self.start_profile()
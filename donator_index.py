@@ -0,0 +1,44 @@
+import time
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+class DonatorIndex:
+    """Resident guild -> active donator entitlements index, kept current by entitlement events."""
+
+    def __init__(self):
+        self.entitlements: Dict[int, Tuple[int, Optional[float]]] = {}
+        self.by_guild: Dict[int, Set[int]] = {}
+
+    def load(self, rows: Iterable[Tuple[str, str, Optional[int]]]):
+        """Rebuild the index from (entitlement_id, guild_id, ends_at) rows."""
+        self.entitlements.clear()
+        self.by_guild.clear()
+        for entitlement_id, guild_id, ends_at in rows:
+            self.add(int(entitlement_id), int(guild_id), ends_at)
+
+    def add(self, entitlement_id: int, guild_id: int, ends_at: Optional[float] = None):
+        self.remove(entitlement_id)
+        self.entitlements[entitlement_id] = (guild_id, ends_at)
+        self.by_guild.setdefault(guild_id, set()).add(entitlement_id)
+
+    def remove(self, entitlement_id: int):
+        entry = self.entitlements.pop(entitlement_id, None)
+        if entry is None:
+            return
+        guild_entitlements = self.by_guild.get(entry[0])
+        if guild_entitlements is not None:
+            guild_entitlements.discard(entitlement_id)
+            if not guild_entitlements:
+                del self.by_guild[entry[0]]
+
+    def is_donator(self, guild_id: int, now: Optional[float] = None) -> bool:
+        entitlement_ids = self.by_guild.get(guild_id)
+        if not entitlement_ids:
+            return False
+        now = time.time() if now is None else now
+        return any(
+            self.entitlements[entitlement_id][1] is None or self.entitlements[entitlement_id][1] > now
+            for entitlement_id in entitlement_ids
+        )
+
+    def __len__(self) -> int:
+        return len(self.by_guild)
@@ -0,0 +1,157 @@
+import asyncio
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _label_key(labels: Dict[str, object]) -> Tuple[Tuple[str, str], ...]:
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def _format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+class Gauge:
+    """A value that is set directly, or read from a callback at scrape time."""
+    kind = 'gauge'
+
+    def __init__(self, name: str, help: str, callback: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.callback = callback
+        self.values: Dict[Tuple[Tuple[str, str], ...], float] = {}
+
+    def set(self, value: float, **labels):
+        self.values[_label_key(labels)] = value
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        if self.callback is not None:
+            yield self.name, (), float(self.callback())
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.values: Dict[Tuple[Tuple[str, str], ...], List[float]] = {}  # bucket counts, then sum and count
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0.0] * (len(self.buckets) + 2)
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[index] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, Tuple[Tuple[str, str], ...], float]]:
+        for labels, counts in self.values.items():
+            for bound, count in zip(self.buckets, counts):
+                yield f'{self.name}_bucket', labels + (('le', repr(bound)),), count
+            yield f'{self.name}_bucket', labels + (('le', '+Inf'),), counts[-1]
+            yield f'{self.name}_sum', labels, counts[-2]
+            yield f'{self.name}_count', labels, counts[-1]
+
+class Registry:
+    """Process-wide set of metrics rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        # Modules may be imported more than once (scripts, benchmarks), keep the first instance
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._register(Counter(name, help))
+
+    def gauge(self, name: str, help: str, callback: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._register(Gauge(name, help, callback))
+
+    def histogram(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, help, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                # repr keeps every digit, :g would round large counters to 6 significant digits
+                lines.append(f'{name}{_format_labels(labels)} {float(value)!r}')
+        return '\n'.join(lines) + '\n'
+
+registry = Registry()
+
+def timed(histogram: Histogram, **labels):
+    """Record how long each call of the decorated function or coroutine function takes."""
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with histogram.time(**labels):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+async def watch_event_loop_lag(histogram: Histogram, interval: float = 1.0):
+    """Sample how late the event loop wakes a sleeping task, which is the lag every other task sees."""
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, time.perf_counter() - start - interval))
+
+async def start_server(host: str = '127.0.0.1', port: int = 9464) -> web.AppRunner:
+    """Serve the registry at /metrics until the returned runner is cleaned up."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
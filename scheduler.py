@@ -0,0 +1,75 @@
+import asyncio
+import heapq
+import time
+from typing import Dict, Iterable, List, Optional
+
+class AiringSchedule:
+    """Min-heap of upcoming airing timestamps with one live entry per anime."""
+
+    def __init__(self, refresh_interval: int = 3600, retry_delay: int = 60):
+        self.refresh_interval = refresh_interval
+        self.retry_delay = retry_delay
+        self.changed = asyncio.Event()
+        self._heap: List[tuple[int, int]] = []
+        self._airing_at: Dict[int, int] = {}
+        self._refreshed_at: Dict[int, float] = {}
+
+    def update(self, anime_id: int, anime_data: Dict, now: Optional[float] = None):
+        """Record freshly fetched data for an anime and schedule its next episode."""
+        now = time.time() if now is None else now
+        self._refreshed_at[anime_id] = now
+
+        next_episode = anime_data.get('nextAiringEpisode')
+        if not next_episode:
+            self._airing_at.pop(anime_id, None)
+            return
+
+        airing_at = next_episode['airingAt']
+        if airing_at <= now:
+            # AniList has not rolled over to the following episode yet, check again shortly.
+            airing_at = int(now) + self.retry_delay
+
+        if self._airing_at.get(anime_id) == airing_at:
+            return
+
+        self._airing_at[anime_id] = airing_at
+        heapq.heappush(self._heap, (airing_at, anime_id))
+        self.changed.set()
+
+    def forget(self, anime_id: int):
+        """Stop tracking an anime nobody is subscribed to anymore."""
+        self._airing_at.pop(anime_id, None)
+        self._refreshed_at.pop(anime_id, None)
+
+    def _discard_outdated(self):
+        while self._heap and self._airing_at.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_airing_at(self) -> Optional[int]:
+        """Return the earliest scheduled airing timestamp, if any."""
+        self._discard_outdated()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: Optional[float] = None) -> List[int]:
+        """Remove and return every anime whose next episode has aired by now."""
+        now = time.time() if now is None else now
+        due = []
+        self._discard_outdated()
+        while self._heap and self._heap[0][0] <= now:
+            _, anime_id = heapq.heappop(self._heap)
+            del self._airing_at[anime_id]
+            due.append(anime_id)
+            self._discard_outdated()
+        return due
+
+    def stale(self, anime_ids: Iterable[int], now: Optional[float] = None, limit: Optional[int] = None) -> List[int]:
+        """Return the anime whose schedule has not been refreshed within the refresh interval, or the stalest limit of them."""
+        now = time.time() if now is None else now
+        stale = [
+            anime_id for anime_id in anime_ids
+            if anime_id not in self._refreshed_at
+            or now - self._refreshed_at[anime_id] >= self.refresh_interval
+        ]
+        if limit is None or len(stale) <= limit:
+            return stale
+        return heapq.nsmallest(limit, stale, key=lambda anime_id: self._refreshed_at.get(anime_id, 0.0))
@@ -0,0 +1,70 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+class ChannelState:
+    __slots__ = ('guild_id', 'anime_ids')
+
+    def __init__(self, guild_id: Optional[int] = None):
+        self.guild_id = guild_id
+        self.anime_ids: Set[int] = set()
+
+class SubscriptionIndex:
+    """Resident anime_id -> {channel_id: last notified episode} index, kept in sync by Database."""
+
+    def __init__(self):
+        self.by_anime: Dict[int, Dict[str, int]] = {}
+        self.channels: Dict[str, ChannelState] = {}
+
+    def load(self, rows: Iterable[Tuple[str, int, int, Optional[str]]]):
+        """Rebuild the index from (channel_id, anime_id, episodes, guild_id) rows."""
+        self.by_anime.clear()
+        self.channels.clear()
+        for channel_id, anime_id, episodes, guild_id in rows:
+            self.add(channel_id, anime_id, episodes, int(guild_id) if guild_id else None)
+
+    def add(self, channel_id: str, anime_id: int, episodes: int, guild_id: Optional[int] = None):
+        self.by_anime.setdefault(anime_id, {})[channel_id] = episodes
+        state = self.channels.get(channel_id)
+        if state is None:
+            state = self.channels[channel_id] = ChannelState(guild_id)
+        elif guild_id is not None:
+            state.guild_id = guild_id
+        state.anime_ids.add(anime_id)
+
+    def remove(self, channel_id: str, anime_id: int):
+        subscribers = self.by_anime.get(anime_id)
+        if subscribers is not None:
+            subscribers.pop(channel_id, None)
+            if not subscribers:
+                del self.by_anime[anime_id]
+
+        state = self.channels.get(channel_id)
+        if state is not None:
+            state.anime_ids.discard(anime_id)
+            if not state.anime_ids:
+                del self.channels[channel_id]
+
+    def remove_channel(self, channel_id: str) -> List[int]:
+        state = self.channels.get(channel_id)
+        if state is None:
+            return []
+        anime_ids = list(state.anime_ids)
+        for anime_id in anime_ids:
+            self.remove(channel_id, anime_id)
+        return anime_ids
+
+    def guild_channels(self, guild_id: int) -> List[str]:
+        return [channel_id for channel_id, state in self.channels.items() if state.guild_id == guild_id]
+
+    def set_episodes(self, channel_id: str, anime_id: int, episodes: int):
+        subscribers = self.by_anime.get(anime_id)
+        if subscribers is not None and channel_id in subscribers:
+            subscribers[channel_id] = max(subscribers[channel_id] or 0, episodes)
+
+    def subscribers(self, anime_id: int) -> Dict[str, int]:
+        return self.by_anime.get(anime_id, {})
+
+    def anime_ids(self) -> Set[int]:
+        return set(self.by_anime)
+
+    def __len__(self) -> int:
+        return sum(len(subscribers) for subscribers in self.by_anime.values())
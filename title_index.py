@@ -0,0 +1,76 @@
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Set
+
+from database import normalize_title
+
+def _trigrams(text: str) -> Set[str]:
+    padded = f'  {text} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TitleIndex:
+    """In-memory trigram index over romaji, English and native anime titles for autocomplete."""
+
+    def __init__(self):
+        self.titles: Dict[int, Dict[str, Optional[str]]] = {}
+        self._keys: Dict[int, List[str]] = {}
+        self._postings: Dict[str, Set[int]] = {}
+
+    def add(self, anime_id: int, romaji: str, english: Optional[str] = None, native: Optional[str] = None):
+        if anime_id in self.titles:
+            self.remove(anime_id)
+
+        self.titles[anime_id] = {'romaji': romaji, 'english': english, 'native': native}
+        keys = [normalize_title(title) for title in (romaji, english, native) if title]
+        self._keys[anime_id] = keys
+        for key in keys:
+            for gram in _trigrams(key):
+                self._postings.setdefault(gram, set()).add(anime_id)
+
+    def remove(self, anime_id: int):
+        self.titles.pop(anime_id, None)
+        for key in self._keys.pop(anime_id, []):
+            for gram in _trigrams(key):
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(anime_id)
+                    if not postings:
+                        del self._postings[gram]
+
+    def search(self, query: str, limit: int = 25) -> List[int]:
+        """Return anime IDs ranked by trigram overlap, favouring prefix and substring matches."""
+        query = normalize_title(query)
+        if not query:
+            return list(self.titles)[:limit]
+
+        grams = _trigrams(query)
+        overlap = Counter()
+        for gram in grams:
+            for anime_id in self._postings.get(gram, ()):
+                overlap[anime_id] += 1
+
+        def score(anime_id: int) -> float:
+            keys = self._keys[anime_id]
+            bonus = 0.0
+            if any(key.startswith(query) for key in keys):
+                bonus = 2.0
+            elif any(query in key for key in keys):
+                bonus = 1.0
+            return overlap[anime_id] / len(grams) + bonus
+
+        candidates = [anime_id for anime_id, count in overlap.items() if count * 3 >= len(grams)]
+        return sorted(candidates, key=score, reverse=True)[:limit]
+
+    @staticmethod
+    def filter_titles(query: str, titles: Iterable[str], limit: int = 25) -> List[str]:
+        """Rank a small list of titles, such as one channel's subscriptions, against a query."""
+        query = normalize_title(query)
+        titles = list(titles)
+        if not query:
+            return titles[:limit]
+        keyed = [(normalize_title(title), title) for title in titles]
+        prefix = [title for key, title in keyed if key.startswith(query)]
+        contains = [title for key, title in keyed if query in key and not key.startswith(query)]
+        return (prefix + contains)[:limit]
+
+    def __len__(self) -> int:
+        return len(self.titles)